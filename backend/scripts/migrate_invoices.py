@@ -0,0 +1,110 @@
+"""
+One-off migrations for invoices stored by older versions of the server
+
+Run once from the backend folder after upgrading, before starting the new server:
+    python scripts/migrate_invoices.py
+Each step only picks up documents still in the old format, so re-running it is safe.
+"""
+import asyncio
+import base64
+import binascii
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from pymongo import UpdateOne
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from server import client, db, delete_invoice_files, logger, store_invoice_file, to_iso_date  # noqa: E402
+
+async def migrate_invoice_dates():
+    """Convert invoice timestamps written as ISO strings into native BSON dates"""
+    cursor = db.invoices.find(
+        {"$or": [{"created_at": {"$type": "string"}}, {"updated_at": {"$type": "string"}}]},
+        {"_id": 1, "created_at": 1, "updated_at": 1}
+    )
+    updates = []
+    migrated = 0
+    async for invoice in cursor:
+        try:
+            fields = {
+                key: datetime.fromisoformat(invoice[key])
+                for key in ("created_at", "updated_at")
+                if isinstance(invoice.get(key), str)
+            }
+        except ValueError as e:
+            logger.error(f"Invoice {invoice['_id']} has an unparseable timestamp, left as a string: {e}")
+            continue
+        updates.append(UpdateOne({"_id": invoice["_id"]}, {"$set": fields}))
+        if len(updates) >= 1000:
+            await db.invoices.bulk_write(updates, ordered=False)
+            migrated += len(updates)
+            updates = []
+    if updates:
+        await db.invoices.bulk_write(updates, ordered=False)
+        migrated += len(updates)
+    logger.info(f"Invoice timestamps converted to dates: {migrated}")
+
+async def backfill_invoice_date_iso():
+    """Fill invoice_date_iso on invoices stored before it existed"""
+    cursor = db.invoices.find(
+        {"invoice_date_iso": {"$exists": False}},
+        {"_id": 1, "extracted_data.invoice_date": 1}
+    )
+    updates = []
+    migrated = 0
+    async for invoice in cursor:
+        invoice_date = (invoice.get('extracted_data') or {}).get('invoice_date') or ""
+        updates.append(UpdateOne({"_id": invoice["_id"]}, {"$set": {"invoice_date_iso": to_iso_date(invoice_date)}}))
+        if len(updates) >= 1000:
+            await db.invoices.bulk_write(updates, ordered=False)
+            migrated += len(updates)
+            updates = []
+    if updates:
+        await db.invoices.bulk_write(updates, ordered=False)
+        migrated += len(updates)
+    logger.info(f"Invoices given an invoice_date_iso: {migrated}")
+
+async def migrate_invoice_files():
+    """Move base64 file_data left on older invoices into GridFS"""
+    # Manual entries were stored with an empty file_data; they have no file to move
+    await db.invoices.update_many({"file_data": {"$exists": True, "$in": [None, ""]}}, {"$unset": {"file_data": ""}})
+    
+    cursor = db.invoices.find(
+        {"file_data": {"$nin": [None, ""]}},
+        {"_id": 1, "file_data": 1, "filename": 1, "file_type": 1, "user_id": 1}
+    ).batch_size(50)
+    migrated = 0
+    async for invoice in cursor:
+        try:
+            file_data = await asyncio.to_thread(base64.b64decode, invoice['file_data'])
+        except (binascii.Error, TypeError) as e:
+            logger.error(f"Invoice {invoice['_id']} has undecodable file_data, left in place: {e}")
+            continue
+        file_id = await store_invoice_file(
+            file_data,
+            invoice.get('filename') or "invoice",
+            invoice.get('file_type'),
+            invoice.get('user_id')
+        )
+        # Guard on file_data so a second run started by mistake doesn't leave an orphaned file
+        result = await db.invoices.update_one(
+            {"_id": invoice['_id'], "file_data": {"$nin": [None, ""]}},
+            {"$set": {"file_id": file_id}, "$unset": {"file_data": ""}}
+        )
+        if result.modified_count:
+            migrated += 1
+        else:
+            await delete_invoice_files([{"file_id": file_id}])
+    logger.info(f"Invoice files moved to GridFS: {migrated}")
+
+async def main():
+    try:
+        await migrate_invoice_dates()
+        await backfill_invoice_date_iso()
+        await migrate_invoice_files()
+    finally:
+        await client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
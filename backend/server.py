@@ -1,24 +1,44 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Depends, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pymongo import AsyncMongoClient
+from gridfs import AsyncGridFSBucket
+from bson import ObjectId
+from gridfs.errors import NoFile
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator
 import uuid
 from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
 import base64
 import io
+import mimetypes
+import tempfile
+import csv
+import string
+from xml.sax.saxutils import escape as xml_escape
 from pypdf import PdfReader
+import PIL.Image
+import PIL.ImageOps
 import asyncio
-import pandas as pd
-import json
+import orjson
 import re
+import calendar
+import hashlib
+import random
+import time
+import functools
+import httpx
+from cachetools import TLRUCache, TTLCache
 
 # LLM imports - Support both Emergent and standard SDKs
 EMERGENT_AVAILABLE = False
@@ -47,19 +67,41 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncMongoClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+# Original invoice files live in GridFS; invoice documents only keep the file id
+invoice_files = AsyncGridFSBucket(db, bucket_name="invoice_files")
+
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Shared connection pool for LLM HTTP calls, so TCP/TLS sessions are reused across requests
+llm_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    timeout=httpx.Timeout(120.0, connect=10.0)
+)
+
+@functools.lru_cache(maxsize=2)
+def get_openai_client(api_key: str) -> "AsyncOpenAI":
+    """Process-wide OpenAI client bound to the shared connection pool"""
+    return AsyncOpenAI(api_key=api_key, http_client=llm_http_client)
+
+@functools.lru_cache(maxsize=4)
+def get_gemini_model(api_key: str, model_name: str):
+    """Process-wide Gemini model handle, configured once per API key"""
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
 # Security
 security = HTTPBearer()
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = "HS256"
+# bcrypt cost factor for new hashes; existing hashes keep the cost they were created with
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
 
 # Models
 class UserRegister(BaseModel):
@@ -150,7 +192,7 @@ class Invoice(BaseModel):
     user_id: str
     invoice_type: str = "purchase"
     filename: str
-    file_data: str
+    file_id: Optional[str] = None  # GridFS id of the original file
     file_type: str
     extracted_data: InvoiceData
     confidence_scores: ConfidenceScores
@@ -158,6 +200,8 @@ class Invoice(BaseModel):
     status: str = "pending"
     month: Optional[str] = None
     financial_year: Optional[str] = None
+    # extracted_data.invoice_date normalised to YYYY-MM-DD for date range filters
+    invoice_date_iso: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -249,47 +293,111 @@ class MonthlyReport(BaseModel):
     gst_breakdown: Dict[str, Any]
 
 # Helper functions
+async def hash_password(password: str) -> str:
+    """Hash a password off the event loop"""
+    hashed = await asyncio.to_thread(bcrypt.hashpw, password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    return hashed.decode()
+
+async def check_password(password: str, password_hash: str) -> bool:
+    """Verify a password against its bcrypt hash off the event loop"""
+    return await asyncio.to_thread(bcrypt.checkpw, password.encode(), password_hash.encode())
+
 def create_access_token(user_id: str, email: str) -> str:
     expire = datetime.now(timezone.utc) + timedelta(days=7)
     to_encode = {"user_id": user_id, "email": email, "exp": expire}
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+TOKEN_CACHE_TTL = 300
+
+def _token_cache_expiry(_key, payload: dict, now: float) -> float:
+    # Never serve a cached payload past the token's own exp claim
+    return min(now + TOKEN_CACHE_TTL, payload['exp'])
+
+# Decoded tokens, keyed by a short digest of the token so the cache stays small;
+# the wall-clock timer keeps expiry comparable with exp
+_token_cache = TLRUCache(maxsize=50_000, ttu=_token_cache_expiry, timer=time.time)
+
 def verify_token(token: str) -> dict:
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    payload = _token_cache.get(cache_key)
+    if payload is not None:
+        return payload
+    
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    
+    _token_cache[cache_key] = payload
+    return payload
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     token = credentials.credentials
     return verify_token(token)
 
+# DD/MM/YYYY (or DD-MM-YY...) as extracted from invoices, or ISO YYYY-MM-DD with an optional time part
+_DATE_RE = re.compile(r'^(?:(\d{1,2})[/-](\d{1,2})[/-](\d{2}|\d{4})|(\d{4})-(\d{2})-(\d{2})(?:T.*)?)$')
+
+def parse_invoice_date(date_str: str) -> Optional[tuple[int, int, int]]:
+    """(year, month, day) of a date string, or None when it isn't a real date"""
+    match = _DATE_RE.match(date_str.strip())
+    if not match:
+        return None
+    
+    if match.group(1):
+        day, month, year = int(match.group(1)), int(match.group(2)), int(match.group(3))
+        if year < 100:
+            year += 2000
+    else:
+        year, month, day = int(match.group(4)), int(match.group(5)), int(match.group(6))
+    
+    # Reject impossible dates (31/02, month 13) without building a datetime
+    if not (1 <= month <= 12 and year >= 1 and 1 <= day <= calendar.monthrange(year, month)[1]):
+        return None
+    return year, month, day
+
+def to_iso_date(date_str: str) -> Optional[str]:
+    """YYYY-MM-DD form of a date string, which sorts and range-filters correctly, or None"""
+    parsed = parse_invoice_date(date_str)
+    return f"{parsed[0]:04d}-{parsed[1]:02d}-{parsed[2]:02d}" if parsed else None
+
 def get_month_and_fy(date_str: str) -> tuple:
     """Extract month and financial year from date string"""
-    try:
-        if '/' in date_str:
-            parts = date_str.split('/')
-            if len(parts) == 3:
-                day, month, year = parts
-                date_obj = datetime(int(year), int(month), int(day))
-        elif '-' in date_str:
-            date_obj = datetime.fromisoformat(date_str.split('T')[0])
-        else:
-            return None, None
-        
-        month_str = date_obj.strftime('%Y-%m')
-        
-        if date_obj.month >= 4:
-            fy = f"{date_obj.year}-{str(date_obj.year + 1)[-2:]}"
-        else:
-            fy = f"{date_obj.year - 1}-{str(date_obj.year)[-2:]}"
-        
-        return month_str, fy
-    except:
+    parsed = parse_invoice_date(date_str)
+    if parsed is None:
         return None, None
+    year, month, _ = parsed
+    
+    month_str = f"{year:04d}-{month:02d}"
+    
+    # Indian financial year runs April to March
+    if month >= 4:
+        fy = f"{year}-{(year + 1) % 100:02d}"
+    else:
+        fy = f"{year - 1}-{year % 100:02d}"
+    
+    return month_str, fy
+
+async def store_invoice_file(file_data: bytes, filename: str, content_type: str, user_id: str) -> str:
+    """Store an uploaded invoice file in GridFS and return its id"""
+    file_id = await invoice_files.upload_from_stream(
+        filename,
+        file_data,
+        metadata={"content_type": content_type, "user_id": user_id}
+    )
+    return str(file_id)
+
+async def delete_invoice_files(invoices: List[dict]):
+    """Remove the GridFS files referenced by the given invoices"""
+    async def delete_one(file_id: str):
+        try:
+            await invoice_files.delete(ObjectId(file_id))
+        except NoFile:
+            pass
+    
+    await asyncio.gather(*(delete_one(inv['file_id']) for inv in invoices if inv.get('file_id')))
 
 async def check_duplicate_invoice(user_id: str, invoice_no: str, invoice_id: Optional[str] = None) -> tuple:
     """Check if invoice number already exists"""
@@ -306,15 +414,78 @@ async def check_duplicate_invoice(user_id: str, invoice_no: str, invoice_id: Opt
     
     return is_duplicate, duplicate_ids
 
-async def validate_gst_number(user_id: str, invoice_type: str, extracted_data: InvoiceData) -> tuple[bool, str]:
-    """Validate GST number against company settings - returns (is_valid, error_message)"""
-    settings = await db.company_settings.find_one({"user_id": user_id}, {"_id": 0})
-    
+async def find_duplicate_invoice(user_id: str, invoice_no: str) -> Optional[str]:
+    """Id of the first invoice already using this number, if any"""
+    duplicate = await db.invoices.find_one(
+        {"user_id": user_id, "extracted_data.invoice_no": invoice_no},
+        {"_id": 0, "id": 1}
+    )
+    return duplicate['id'] if duplicate else None
+
+async def duplicate_invoice_error(user_id: str, invoice_no: str) -> HTTPException:
+    """Build the 400 raised when an insert hits the unique invoice number index"""
+    duplicate_id = await find_duplicate_invoice(user_id, invoice_no)
+    existing = f" (ID: {duplicate_id})" if duplicate_id else ""
+    return HTTPException(
+        status_code=400,
+        detail=f"Duplicate Invoice Number: Invoice #{invoice_no} already exists in the system{existing}. Please check existing invoices."
+    )
+
+# Set by create_indexes once user_invoice_no_unique exists; until then single and manual
+# uploads look duplicates up before inserting, as batch upload always does
+unique_invoice_no_index = False
+
+async def reject_duplicate_invoice(user_id: str, invoice_no: str):
+    """Raise the duplicate 400 up front when the unique index isn't there to do it on insert"""
+    if unique_invoice_no_index or not invoice_no:
+        return
+    if await find_duplicate_invoice(user_id, invoice_no):
+        raise await duplicate_invoice_error(user_id, invoice_no)
+
+# Company settings per user; entries are dropped when this process updates them,
+# other workers see changes once the TTL expires
+_settings_cache = TTLCache(maxsize=10_000, ttl=60)
+
+async def get_company_settings_cached(user_id: str) -> dict:
+    """Company settings for a user, or an empty dict when none are saved"""
+    settings = _settings_cache.get(user_id)
+    if settings is None:
+        settings = await db.company_settings.find_one({"user_id": user_id}, {"_id": 0}) or {}
+        _settings_cache[user_id] = settings
+    return settings
+
+# Monthly reports per user and period; a user's entries are dropped when this process writes
+# their invoices, other workers see changes once the TTL expires
+_report_cache = TTLCache(maxsize=10_000, ttl=60)
+
+def invalidate_reports(user_id: str):
+    """Drop the cached reports of a user whose invoices changed"""
+    _report_cache.pop(user_id, None)
+
+GST_NOT_CONFIGURED = "Company GST number not configured. Please update Settings first."
+
+async def require_company_gst(user_id: str) -> dict:
+    """Fetch company settings, rejecting the request up front when no company GST is configured"""
+    settings = await get_company_settings_cached(user_id)
     if not settings or not settings.get('company_gst_no'):
-        return False, "Company GST number not configured. Please update Settings first."
+        raise HTTPException(status_code=400, detail=GST_NOT_CONFIGURED)
+    return settings
+
+async def validate_gst_number(user_id: str, invoice_type: str, extracted_data: InvoiceData, settings: Optional[dict] = None) -> tuple[bool, str]:
+    """Validate GST number against company settings - returns (is_valid, error_message)
+
+    Pass settings when they were already fetched for the request (an empty dict if the user has none).
+    """
+    if settings is None:
+        settings = await get_company_settings_cached(user_id)
     
-    company_gst = settings['company_gst_no'].upper().strip()
+    if not settings or not settings.get('company_gst_no'):
+        return False, GST_NOT_CONFIGURED
     
+    return check_gst_match(invoice_type, extracted_data, settings['company_gst_no'].upper().strip())
+
+def check_gst_match(invoice_type: str, extracted_data: InvoiceData, company_gst: str) -> tuple[bool, str]:
+    """Compare the invoice's company-side GST number with an already normalised company GST"""
     if invoice_type == "purchase":
         # For purchase invoices: Bill To GST (buyer) should be our company GST
         bill_to_gst = (extracted_data.buyer_gst_no or extracted_data.gst_no or "").upper().strip()
@@ -332,8 +503,417 @@ async def validate_gst_number(user_id: str, invoice_type: str, extracted_data: I
             return False, f"Invalid Sales Invoice: Bill From GST ({bill_from_gst}) does not match company GST ({company_gst})"
         return True, ""
 
-async def extract_invoice_data(file_data: bytes, filename: str, invoice_type: str = "purchase") -> tuple[InvoiceData, ConfidenceScores]:
-    """Extract invoice data using AI - Supports Emergent, OpenAI, and Gemini"""
+_INVOICE_PROMPT_TEMPLATE = string.Template("""Extract the following information from this $kind invoice:
+        
+        CRITICAL: Extract BOTH supplier (Bill From) and buyer (Bill To) details.
+        
+        - Invoice No
+        - Invoice Date (in DD/MM/YYYY format)
+        
+        **BILL FROM / SUPPLIER DETAILS $supplier_role:**
+        - Supplier Name
+        - Supplier Address
+        - Supplier GST No
+        
+        **BILL TO / BUYER DETAILS $buyer_role:**
+        - Buyer Name
+        - Buyer Address
+        - Buyer GST No
+        
+        **AMOUNTS:**
+        - Basic Amount (taxable amount before GST)
+        - GST Amount (total GST)
+        - Total Amount (final $total_role amount)
+        
+        Respond in JSON format:
+        {
+            "data": {"invoice_no": "...", "invoice_date": "DD/MM/YYYY", "supplier_name": "...", "supplier_address": "...", "supplier_gst_no": "...", "buyer_name": "...", "buyer_address": "...", "buyer_gst_no": "...", "basic_amount": 0, "gst": 0, "total_amount": 0},
+            "confidence": {"invoice_no": 95, ...}
+        }
+        """)
+
+# Rendered once at import; purchase and sales prompts differ only in who the parties are
+INVOICE_PROMPTS = {
+    "purchase": _INVOICE_PROMPT_TEMPLATE.substitute(
+        kind="PURCHASE", supplier_role="(Who is selling)", buyer_role="(Who is purchasing)", total_role="payable"
+    ),
+    "sales": _INVOICE_PROMPT_TEMPLATE.substitute(
+        kind="SALES", supplier_role="(Your company)", buyer_role="(Customer)", total_role="receivable"
+    ),
+}
+
+INVOICE_SYSTEM_MESSAGE = "You are an expert invoice data extraction assistant. Extract structured data accurately. Return only valid JSON."
+
+def invoice_prompt(invoice_type: str) -> str:
+    """Return the extraction prompt for a purchase or sales invoice"""
+    return INVOICE_PROMPTS["purchase" if invoice_type == "purchase" else "sales"]
+
+def extract_pdf_text(file_data: bytes, separator: str = "") -> str:
+    """Extract the text of every page of a PDF - CPU bound, run it via asyncio.to_thread"""
+    reader = PdfReader(io.BytesIO(file_data))
+    return separator.join(page.extract_text() or "" for page in reader.pages)
+
+# Regex fast path for text PDFs whose key fields are plainly labelled; opt-in, and its
+# fields are scored below the "verified" band so the invoices still get reviewed
+INVOICE_FAST_PATH = os.environ.get('INVOICE_FAST_PATH', 'false').lower() == 'true'
+FAST_PATH_CONFIDENCE = 0.8
+
+_AMOUNT = r'\s*[:\-]?\s*(?:₹|Rs\.?|INR)?\s*([\d,]+(?:\.\d{1,2})?)'
+_NAME_END_RE = re.compile(r'\s{2,}|\bGSTIN\b')
+_GSTIN_RE = re.compile(r'\b\d{2}[A-Z]{5}\d{4}[A-Z][1-9A-Z]Z[0-9A-Z]\b')
+_FAST_FIELD_RES = {
+    "invoice_no": re.compile(r'Invoice\s*(?:(?:Number|No)\b|#)\.?\s*[:\-]?\s*([A-Z0-9][A-Z0-9/\-]*)', re.I),
+    "supplier_name": re.compile(r'(?:Supplier|Seller|Bill(?:ed)?\s*From)\s*(?:Name)?\s*[:\-]\s*([^\n]+)', re.I),
+    "buyer_name": re.compile(r'(?:Buyer|Customer|Bill(?:ed)?\s*To)\s*(?:Name)?\s*[:\-]\s*([^\n]+)', re.I),
+    "basic_amount": re.compile(r'(?:Taxable\s*(?:Value|Amount)|Basic\s*Amount|Sub\s*-?\s*Total)' + _AMOUNT, re.I),
+    "gst": re.compile(r'(?:Total\s*(?:GST|Tax)|GST\s*Amount)' + _AMOUNT, re.I),
+    "total_amount": re.compile(r'(?:Grand\s*Total|Total\s*Amount|Invoice\s*Total|Amount\s*Payable)' + _AMOUNT, re.I),
+}
+# Dates with the word before "Date" captured, so due / order dates can be skipped
+_FAST_DATE_RE = re.compile(r'(?:\b([A-Z]+)\s*)?\bDate\s*[:\-]?\s*(\d{2}[/\-.]\d{2}[/\-.]\d{4})', re.I)
+_OTHER_DATE_LABELS = {"due", "order", "po", "delivery", "dispatch"}
+
+def fast_extract_invoice(text: str) -> Optional[tuple[InvoiceData, ConfidenceScores]]:
+    """Pull labelled fields out of PDF text with regexes; None unless every key field is found and the amounts add up"""
+    fields = {}
+    label_positions = {}
+    for name, pattern in _FAST_FIELD_RES.items():
+        match = pattern.search(text)
+        if match:
+            fields[name] = match.group(1).strip()
+            label_positions[name] = match.start()
+    
+    for match in _FAST_DATE_RE.finditer(text):
+        if (match.group(1) or "").lower() not in _OTHER_DATE_LABELS:
+            fields["invoice_date"] = match.group(2)
+            break
+    
+    # Names often share their line with a GSTIN or another column
+    for name in ("supplier_name", "buyer_name"):
+        if name in fields:
+            fields[name] = _NAME_END_RE.split(fields[name], maxsplit=1)[0].strip()
+    
+    required = ("invoice_no", "invoice_date", "supplier_name", "basic_amount", "gst", "total_amount")
+    if any(not fields.get(name) for name in required):
+        return None
+    
+    try:
+        for name in ("basic_amount", "gst", "total_amount"):
+            fields[name] = float(fields[name].replace(",", ""))
+    except ValueError:
+        return None
+    if abs(fields["basic_amount"] + fields["gst"] - fields["total_amount"]) > 1:
+        return None
+    
+    # Each GSTIN belongs to the nearest supplier / buyer label before it; GSTINs above both
+    # labels are the letterhead, i.e. the seller's
+    gst_owners = {}
+    for match in _GSTIN_RE.finditer(text):
+        preceding = [(pos, name) for name, pos in label_positions.items()
+                     if name in ("supplier_name", "buyer_name") and pos < match.start()]
+        owner = max(preceding)[1] if preceding else "supplier_name"
+        gst_owners.setdefault(owner, match.group(0))
+    if "supplier_name" not in gst_owners:
+        return None
+    fields["supplier_gst_no"] = gst_owners["supplier_name"]
+    if "buyer_name" in gst_owners:
+        fields["buyer_gst_no"] = gst_owners["buyer_name"]
+    fields["invoice_date"] = fields["invoice_date"].replace("-", "/").replace(".", "/")
+    
+    return InvoiceData(**fields), ConfidenceScores(
+        invoice_no=FAST_PATH_CONFIDENCE, invoice_date=FAST_PATH_CONFIDENCE, supplier_name=FAST_PATH_CONFIDENCE,
+        address=0.0, gst_no=FAST_PATH_CONFIDENCE, basic_amount=FAST_PATH_CONFIDENCE,
+        gst=FAST_PATH_CONFIDENCE, total_amount=FAST_PATH_CONFIDENCE
+    )
+
+# Upload limits checked before any LLM call
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(10 * 1024 * 1024)))
+MIN_IMAGE_SIDE = int(os.environ.get('MIN_IMAGE_SIDE', '400'))
+MAX_PDF_PAGES = int(os.environ.get('MAX_PDF_PAGES', '20'))
+
+UPLOAD_READ_CHUNK = 1 << 20
+# Whole request bodies: a full 20-file batch plus room for the multipart framing
+MAX_REQUEST_BYTES = int(os.environ.get('MAX_REQUEST_BYTES', str(20 * MAX_UPLOAD_BYTES + (1 << 20))))
+
+class RequestSizeLimitMiddleware:
+    """Refuse oversized bodies from their Content-Length, before multipart parsing spools them
+    
+    Plain ASGI rather than @app.middleware("http"), so other requests and streamed responses
+    pass straight through without BaseHTTPMiddleware's extra task and stream wrapping.
+    """
+    def __init__(self, app: ASGIApp, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > self.max_bytes:
+                        response = ORJSONResponse(status_code=413, content={"detail": "Request too large"})
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+# Registered before CORS, so CORS stays outermost and 413s still carry its headers
+app.add_middleware(RequestSizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Read an upload in chunks, giving up with 413 as soon as it passes MAX_UPLOAD_BYTES"""
+    buffer = bytearray()
+    while chunk := await file.read(UPLOAD_READ_CHUNK):
+        buffer += chunk
+        if len(buffer) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"File too large. Maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.")
+    return bytes(buffer)
+
+def validate_invoice_file(file_data: bytes, content_type: str):
+    """Reject files that are too large, unreadable or too small to OCR - CPU bound, run it via asyncio.to_thread"""
+    if len(file_data) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File too large. Maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.")
+    
+    if content_type == 'application/pdf':
+        try:
+            page_count = len(PdfReader(io.BytesIO(file_data)).pages)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Could not read PDF file.")
+        if page_count == 0 or page_count > MAX_PDF_PAGES:
+            raise HTTPException(status_code=400, detail=f"PDF must have between 1 and {MAX_PDF_PAGES} pages.")
+        return
+    
+    try:
+        # Only the header is decoded here; verify() checks the rest without rendering pixels
+        image = PIL.Image.open(io.BytesIO(file_data))
+        size = image.size
+        image.verify()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Could not read image file.")
+    if min(size) < MIN_IMAGE_SIDE:
+        raise HTTPException(status_code=400, detail=f"Image resolution too low. Both sides must be at least {MIN_IMAGE_SIDE} pixels.")
+
+# Longest side, in pixels, of images sent to the LLM - larger scans only cost tokens and upload time
+MAX_IMAGE_SIDE = int(os.environ.get('LLM_MAX_IMAGE_SIDE', '2048'))
+EXIF_ORIENTATION = 0x0112
+
+def prepare_image(file_data: bytes) -> bytes:
+    """Downscale an invoice image and re-encode it as JPEG - CPU bound, run it via asyncio.to_thread"""
+    image = PIL.Image.open(io.BytesIO(file_data))
+    if (image.format == "JPEG" and max(image.size) <= MAX_IMAGE_SIDE
+            and image.getexif().get(EXIF_ORIENTATION, 1) == 1):
+        return file_data
+
+    # Re-encoding drops EXIF, so apply the camera's orientation to the pixels first
+    image = PIL.ImageOps.exif_transpose(image)
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), PIL.Image.Resampling.LANCZOS)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85, optimize=True)
+    return buffer.getvalue()
+
+# Successful extractions keyed by (SHA-256 of file, invoice type), so re-uploads skip the LLM
+EXTRACTION_CACHE_TTL = int(os.environ.get('EXTRACTION_CACHE_TTL', '86400'))
+_extraction_cache = TTLCache(maxsize=10_000, ttl=EXTRACTION_CACHE_TTL)
+
+def extraction_cache_key(file_data: bytes, invoice_type: str) -> tuple[str, str]:
+    return hashlib.sha256(file_data).hexdigest(), invoice_type
+
+def get_cached_extraction(cache_key: tuple[str, str]) -> Optional[tuple[InvoiceData, ConfidenceScores]]:
+    cached = _extraction_cache.get(cache_key)
+    if cached is None:
+        return None
+    data, confidence = cached
+    return InvoiceData(**data), ConfidenceScores(**confidence)
+
+def cache_extraction(cache_key: tuple[str, str], extraction: tuple[InvoiceData, ConfidenceScores]) -> None:
+    invoice_data, confidence_scores = extraction
+    _extraction_cache[cache_key] = (invoice_data.model_dump(), confidence_scores.model_dump())
+
+# Cheapest model first per provider; escalate to the next tier only when the
+# response is unusable or any field comes back below MIN_TIER_CONFIDENCE
+MODEL_TIERS = {
+    "emergent": ["gemini-2.5-flash-lite", "gemini-2.5-flash"],
+    "gemini": ["gemini-1.5-flash-8b", "gemini-1.5-flash"],
+    "openai": ["gpt-4o-mini", "gpt-4o"],
+}
+MIN_TIER_CONFIDENCE = 0.7
+model_tier_hits: Dict[str, int] = {}
+
+# Process-wide cap on in-flight LLM requests, shared by every upload
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', '16'))
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+LLM_MAX_ATTEMPTS = 3
+
+class ExtractionError(Exception):
+    """No LLM provider could extract the invoice"""
+
+def is_rate_limited(error: Exception) -> bool:
+    """Best-effort detection of provider rate limiting across the three SDKs"""
+    if getattr(error, 'status_code', None) == 429 or getattr(error, 'code', None) == 429:
+        return True
+    message = str(error).lower()
+    return "429" in message or "rate limit" in message or "resource exhausted" in message or "quota" in message
+
+async def call_llm(call, model_name: str) -> str:
+    """Run one provider call under llm_semaphore, retrying rate-limited calls with jittered exponential backoff"""
+    for attempt in range(LLM_MAX_ATTEMPTS):
+        try:
+            async with llm_semaphore:
+                return await call(model_name)
+        except Exception as e:
+            if attempt == LLM_MAX_ATTEMPTS - 1 or not is_rate_limited(e):
+                raise
+            delay = 2 ** attempt + random.random()
+            logging.warning(f"{model_name} rate limited, retrying in {delay:.1f}s")
+        # Back off outside the semaphore so other requests can use the slot
+        await asyncio.sleep(delay)
+
+# Temp files handed to the Emergent SDK go to RAM-backed /dev/shm when available, so they never touch disk
+LLM_TEMP_DIR = os.environ.get('LLM_TEMP_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+def write_llm_temp_file(data: bytes, suffix: str) -> str:
+    """Write data to a uniquely named temp file in LLM_TEMP_DIR and return its path; the caller unlinks it"""
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False, dir=LLM_TEMP_DIR) as f:
+        f.write(data)
+        return f.name
+
+async def call_emergent(api_key: str, model_name: str, prompt: str, file_data: bytes, mime_type: str) -> str:
+    # The Emergent SDK only accepts a file path, so this is the one provider that needs a temp file.
+    # The name is generated by tempfile and the extension follows the bytes actually sent (images
+    # may have been re-encoded as JPEG), never the untrusted upload filename.
+    suffix = mimetypes.guess_extension(mime_type) or ""
+    temp_file = await asyncio.to_thread(write_llm_temp_file, file_data, suffix)
+    try:
+        chat = LlmChat(
+            api_key=api_key,
+            session_id=uuid.uuid4().hex,
+            system_message=INVOICE_SYSTEM_MESSAGE
+        ).with_model("gemini", model_name)
+        
+        file_content = FileContentWithMimeType(
+            file_path=temp_file,
+            mime_type=mime_type
+        )
+        
+        user_message = UserMessage(
+            text=prompt,
+            file_contents=[file_content]
+        )
+        
+        return await chat.send_message(user_message)
+    finally:
+        os.unlink(temp_file)
+
+# Gemini accepts request payloads up to 20 MB; larger files go through the File API
+GEMINI_INLINE_LIMIT = 19 * 1024 * 1024
+
+async def call_gemini(api_key: str, model_name: str, prompt: str, file_data: bytes, mime_type: str) -> str:
+    model = get_gemini_model(api_key, model_name)
+    
+    if len(file_data) < GEMINI_INLINE_LIMIT:
+        # Inline the file in the request: one round-trip, nothing to clean up afterwards
+        response = await asyncio.to_thread(model.generate_content, [prompt, {"mime_type": mime_type, "data": file_data}])
+    else:
+        uploaded_file = await asyncio.to_thread(genai.upload_file, io.BytesIO(file_data), mime_type=mime_type)
+        try:
+            response = await asyncio.to_thread(model.generate_content, [prompt, uploaded_file])
+        finally:
+            await asyncio.to_thread(genai.delete_file, uploaded_file.name)
+    
+    return response.text
+
+async def call_openai(api_key: str, model_name: str, prompt: str, file_data: bytes, mime_type: str, pdf_text: Optional[str] = None) -> str:
+    client = get_openai_client(api_key)
+    
+    if mime_type == "application/pdf":
+        response = await client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {"role": "system", "content": INVOICE_SYSTEM_MESSAGE},
+                {"role": "user", "content": f"{prompt}\n\nInvoice Text:\n{pdf_text}"}
+            ],
+            temperature=0.1
+        )
+    else:
+        base64_image = base64.b64encode(file_data).decode("utf-8")
+        
+        response = await client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {"role": "system", "content": INVOICE_SYSTEM_MESSAGE},
+                {"role": "user", "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}}
+                ]}
+            ],
+            temperature=0.1,
+            max_tokens=4096
+        )
+    
+    return response.choices[0].message.content
+
+# Markdown code fences LLMs like to wrap their JSON in
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.S)
+# Repairs for the usual LLM JSON slips: trailing commas and unquoted keys
+_TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+_UNQUOTED_KEY_RE = re.compile(r'(\{|\,)\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:')
+
+def find_json_span(text: str, opener: str = "{") -> Optional[str]:
+    """Slice out the first balanced JSON object (or array, with opener="[") in text, ignoring brackets inside strings"""
+    start = text.find(opener)
+    if start == -1:
+        return None
+    closer = "}" if opener == "{" else "]"
+    depth = 0
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == opener:
+            depth += 1
+        elif char == closer:
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+def parse_llm_json(response_text: str, opener: str = "{") -> Any:
+    """Strip markdown fences from an LLM response and parse the JSON it contains"""
+    response_text = _FENCE_RE.sub("", response_text.strip())
+    try:
+        return orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        # Prose around the payload - fall back to the first complete JSON value
+        span = find_json_span(response_text, opener)
+        if span is None:
+            raise
+        return orjson.loads(span)
+
+def parse_invoice_response(response_text: str) -> tuple[InvoiceData, ConfidenceScores]:
+    """Parse an LLM invoice extraction response into models"""
+    return build_extraction_result(parse_llm_json(response_text))
+
+async def extract_invoice_data(file_data: bytes, filename: str, invoice_type: str = "purchase", fallback_to_default: bool = True) -> tuple[InvoiceData, ConfidenceScores]:
+    """Extract invoice data using AI - Supports Emergent, OpenAI, and Gemini
+
+    On failure returns an empty result for manual entry, or raises ExtractionError when fallback_to_default is False.
+    """
+    cache_key = extraction_cache_key(file_data, invoice_type)
+    cached = get_cached_extraction(cache_key)
+    if cached is not None:
+        logging.info(f"Invoice extraction cache hit for {filename}")
+        return cached
+
     try:
         # Check for API keys - Emergent first, then standard keys
         emergent_key = os.environ.get('EMERGENT_LLM_KEY')
@@ -343,10 +923,6 @@ async def extract_invoice_data(file_data: bytes, filename: str, invoice_type: st
         if not emergent_key and not google_key and not openai_key:
             raise ValueError("No LLM API key found. Set EMERGENT_LLM_KEY, GOOGLE_API_KEY, or OPENAI_API_KEY")
 
-        temp_file = f"/tmp/{uuid.uuid4()}_{filename}"
-        with open(temp_file, "wb") as f:
-            f.write(file_data)
-
         if filename.lower().endswith('.pdf'):
             mime_type = "application/pdf"
         elif filename.lower().endswith(('.jpg', '.jpeg')):
@@ -356,223 +932,193 @@ async def extract_invoice_data(file_data: bytes, filename: str, invoice_type: st
         else:
             mime_type = "application/octet-stream"
 
-        if invoice_type == "purchase":
-            prompt = """Extract the following information from this PURCHASE invoice:
-            
-            CRITICAL: Extract BOTH supplier (Bill From) and buyer (Bill To) details.
-            
-            - Invoice No
-            - Invoice Date (in DD/MM/YYYY format)
-            
-            **BILL FROM / SUPPLIER DETAILS (Who is selling):**
-            - Supplier Name
-            - Supplier Address
-            - Supplier GST No
-            
-            **BILL TO / BUYER DETAILS (Who is purchasing):**
-            - Buyer Name
-            - Buyer Address
-            - Buyer GST No
-            
-            **AMOUNTS:**
-            - Basic Amount (taxable amount before GST)
-            - GST Amount (total GST)
-            - Total Amount (final payable amount)
-            
-            Respond in JSON format:
-            {
-                "data": {"invoice_no": "...", "invoice_date": "DD/MM/YYYY", "supplier_name": "...", "supplier_address": "...", "supplier_gst_no": "...", "buyer_name": "...", "buyer_address": "...", "buyer_gst_no": "...", "basic_amount": 0, "gst": 0, "total_amount": 0},
-                "confidence": {"invoice_no": 95, ...}
-            }
-            """
-        else:
-            prompt = """Extract the following information from this SALES invoice:
-            
-            CRITICAL: Extract BOTH supplier (Bill From) and buyer (Bill To) details.
-            
-            - Invoice No
-            - Invoice Date (in DD/MM/YYYY format)
-            
-            **BILL FROM / SUPPLIER DETAILS (Your company):**
-            - Supplier Name
-            - Supplier Address
-            - Supplier GST No
-            
-            **BILL TO / BUYER DETAILS (Customer):**
-            - Buyer Name
-            - Buyer Address
-            - Buyer GST No
-            
-            **AMOUNTS:**
-            - Basic Amount (taxable amount before GST)
-            - GST Amount (total GST)
-            - Total Amount (final receivable amount)
-            
-            Respond in JSON format:
-            {
-                "data": {"invoice_no": "...", "invoice_date": "DD/MM/YYYY", "supplier_name": "...", "supplier_address": "...", "supplier_gst_no": "...", "buyer_name": "...", "buyer_address": "...", "buyer_gst_no": "...", "basic_amount": 0, "gst": 0, "total_amount": 0},
-                "confidence": {"invoice_no": 95, ...}
-            }
-            """
-
-        response_text = None
-        
-        # Method 1: Try Emergent integration first (if available)
-        if emergent_key and EMERGENT_AVAILABLE:
+        if mime_type.startswith("image/"):
             try:
-                chat = LlmChat(
-                    api_key=emergent_key,
-                    session_id=str(uuid.uuid4()),
-                    system_message=f"You are an expert invoice data extraction assistant. Extract structured data accurately. Return only valid JSON."
-                ).with_model("gemini", "gemini-2.5-flash")
-                
-                file_content = FileContentWithMimeType(
-                    file_path=temp_file,
-                    mime_type=mime_type
-                )
-                
-                user_message = UserMessage(
-                    text=prompt,
-                    file_contents=[file_content]
-                )
-                
-                response_text = await chat.send_message(user_message)
-                logging.info("Invoice extraction successful with Emergent/Gemini")
-            except Exception as e:
-                logging.warning(f"Emergent extraction failed: {str(e)}, trying standard SDKs...")
-        
-        # Method 2: Try standard Gemini SDK (supports PDF natively)
-        if response_text is None and google_key and GEMINI_AVAILABLE:
-            try:
-                genai.configure(api_key=google_key)
-                model = genai.GenerativeModel("gemini-1.5-flash")
-                
-                if mime_type == "application/pdf":
-                    uploaded_file = genai.upload_file(temp_file, mime_type=mime_type)
-                    response = model.generate_content([prompt, uploaded_file])
-                    genai.delete_file(uploaded_file.name)
-                else:
-                    import PIL.Image
-                    image = PIL.Image.open(temp_file)
-                    response = model.generate_content([prompt, image])
-                
-                response_text = response.text
-                logging.info("Invoice extraction successful with Gemini SDK")
+                file_data = await asyncio.to_thread(prepare_image, file_data)
+                mime_type = "image/jpeg"
             except Exception as e:
-                logging.warning(f"Gemini SDK extraction failed: {str(e)}, trying OpenAI...")
+                logging.warning(f"Could not downscale {filename}: {str(e)}, sending original image")
+
+        pdf_text = None
+        if mime_type == "application/pdf" and (INVOICE_FAST_PATH or (openai_key and OPENAI_AVAILABLE)):
+            pdf_text = await asyncio.to_thread(extract_pdf_text, file_data)
         
-        # Method 3: Fallback to OpenAI SDK
-        if response_text is None and openai_key and OPENAI_AVAILABLE:
-            try:
-                client = AsyncOpenAI(api_key=openai_key)
-                
-                if mime_type == "application/pdf":
-                    reader = PdfReader(temp_file)
-                    pdf_text = ""
-                    for page in reader.pages:
-                        pdf_text += page.extract_text() or ""
-                    
-                    response = await client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[
-                            {"role": "system", "content": "You are an expert invoice data extraction assistant. Return only valid JSON."},
-                            {"role": "user", "content": f"{prompt}\n\nInvoice Text:\n{pdf_text}"}
-                        ],
-                        temperature=0.1
-                    )
-                    response_text = response.choices[0].message.content
-                else:
-                    with open(temp_file, "rb") as f:
-                        base64_image = base64.b64encode(f.read()).decode("utf-8")
-                    
-                    response = await client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[
-                            {"role": "system", "content": "You are an expert invoice data extraction assistant. Return only valid JSON."},
-                            {"role": "user", "content": [
-                                {"type": "text", "text": prompt},
-                                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}}
-                            ]}
-                        ],
-                        temperature=0.1,
-                        max_tokens=4096
-                    )
-                    response_text = response.choices[0].message.content
+        if INVOICE_FAST_PATH and pdf_text:
+            extraction = fast_extract_invoice(pdf_text)
+            if extraction is not None:
+                logging.info(f"Invoice {filename} extracted by the regex fast path")
+                cache_extraction(cache_key, extraction)
+                return extraction
+
+        prompt = invoice_prompt(invoice_type)
+
+        # Providers in order of preference: Emergent, then the standard Gemini SDK (supports PDF natively), then OpenAI
+        providers = []
+        if emergent_key and EMERGENT_AVAILABLE:
+            providers.append(("emergent", lambda model_name: call_emergent(emergent_key, model_name, prompt, file_data, mime_type)))
+        if google_key and GEMINI_AVAILABLE:
+            providers.append(("gemini", lambda model_name: call_gemini(google_key, model_name, prompt, file_data, mime_type)))
+        if openai_key and OPENAI_AVAILABLE:
+            providers.append(("openai", lambda model_name: call_openai(openai_key, model_name, prompt, file_data, mime_type, pdf_text)))
+
+        extraction = None
+        for provider, call in providers:
+            for model_name in MODEL_TIERS[provider]:
+                try:
+                    extraction = parse_invoice_response(await call_llm(call, model_name))
+                    tier = f"{provider}/{model_name}"
+                except Exception as e:
+                    logging.warning(f"{provider}/{model_name} extraction failed: {str(e)}")
+                    continue
                 
-                logging.info("Invoice extraction successful with OpenAI SDK")
-            except Exception as e:
-                logging.error(f"OpenAI SDK extraction failed: {str(e)}")
-        
-        # Clean up temp file
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+                if min(extraction[1].model_dump().values()) >= MIN_TIER_CONFIDENCE:
+                    break
+                logging.info(f"{tier} returned low-confidence fields, escalating")
+            
+            # Only fall through to the next provider when every tier of this one failed
+            if extraction is not None:
+                model_tier_hits[tier] = model_tier_hits.get(tier, 0) + 1
+                logging.info(f"Invoice extraction successful with {tier} (tier hits: {model_tier_hits})")
+                break
         
-        if response_text is None:
+        if extraction is None:
             raise ValueError("All AI models failed to extract invoice data")
 
-        # Parse JSON response
-        response_text = response_text.strip()
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
-        
-        json_match = re.search(r'\{[\s\S]*\}', response_text)
-        if json_match:
-            response_text = json_match.group(0)
-        
-        result = json.loads(response_text)
-        
-        data = result.get("data", {})
-        confidence = result.get("confidence", {})
-        
-        invoice_data = InvoiceData(**data)
-        confidence_scores = ConfidenceScores(
-            invoice_no=confidence.get("invoice_no", 85) / 100,
-            invoice_date=confidence.get("invoice_date", 85) / 100,
-            supplier_name=confidence.get("supplier_name", 85) / 100,
-            address=confidence.get("address", 85) / 100,
-            gst_no=confidence.get("gst_no", 85) / 100,
-            basic_amount=confidence.get("basic_amount", 85) / 100,
-            gst=confidence.get("gst", 85) / 100,
-            total_amount=confidence.get("total_amount", 85) / 100
-        )
-        
-        return invoice_data, confidence_scores
+        cache_extraction(cache_key, extraction)
+        return extraction
 
     except Exception as e:
         logging.error(f"Error extracting invoice data: {str(e)}")
-        if 'temp_file' in locals() and os.path.exists(temp_file):
-            os.remove(temp_file)
-        return InvoiceData(), ConfidenceScores(
-            invoice_no=0.5, invoice_date=0.5, supplier_name=0.5, address=0.5,
-            gst_no=0.5, basic_amount=0.5, gst=0.5, total_amount=0.5
-        )
+        if not fallback_to_default:
+            raise ExtractionError(str(e)) from e
+        return default_extraction_result()
+
+def build_extraction_result(result: dict) -> tuple[InvoiceData, ConfidenceScores]:
+    """Convert a parsed {"data": ..., "confidence": ...} LLM payload into models"""
+    data = result.get("data", {})
+    confidence = result.get("confidence", {})
+
+    invoice_data = InvoiceData(**data)
+    confidence_scores = ConfidenceScores(
+        invoice_no=confidence.get("invoice_no", 85) / 100,
+        invoice_date=confidence.get("invoice_date", 85) / 100,
+        supplier_name=confidence.get("supplier_name", 85) / 100,
+        address=confidence.get("address", 85) / 100,
+        gst_no=confidence.get("gst_no", 85) / 100,
+        basic_amount=confidence.get("basic_amount", 85) / 100,
+        gst=confidence.get("gst", 85) / 100,
+        total_amount=confidence.get("total_amount", 85) / 100
+    )
+
+    return invoice_data, confidence_scores
+
+def default_extraction_result() -> tuple[InvoiceData, ConfidenceScores]:
+    """Empty result returned when extraction fails, so the user can fill it in manually"""
+    return InvoiceData(), ConfidenceScores(
+        invoice_no=0.5, invoice_date=0.5, supplier_name=0.5, address=0.5,
+        gst_no=0.5, basic_amount=0.5, gst=0.5, total_amount=0.5
+    )
+
+async def extract_invoice_data_many(files: List[tuple[bytes, str]], invoice_type: str = "purchase") -> List[Optional[tuple[InvoiceData, ConfidenceScores]]]:
+    """Extract several invoices concurrently (LLM calls are bounded by llm_semaphore); None marks a failed file"""
+    results = await asyncio.gather(
+        *(extract_invoice_data(file_data, filename, invoice_type, fallback_to_default=False) for file_data, filename in files),
+        return_exceptions=True
+    )
+    return [None if isinstance(result, BaseException) else result for result in results]
+
+BATCH_PROMPT_SUFFIX = """
+            The images that follow are {count} separate invoices, numbered 0 to {last} in the order given.
+            Extract each invoice independently and respond with a JSON array instead, one element per invoice:
+            [
+                {{"index": 0, "data": {{"invoice_no": "...", ...}}, "confidence": {{"invoice_no": 95, ...}}}},
+                ...
+            ]
+            """
+
+async def extract_invoices_batch(files: List[tuple[bytes, str]], invoice_type: str = "purchase") -> List[Optional[tuple[InvoiceData, ConfidenceScores]]]:
+    """Extract several invoices at once - a single multi-image Gemini call when possible, otherwise one call per file"""
+    emergent_key = os.environ.get('EMERGENT_LLM_KEY')
+    google_key = os.environ.get('GOOGLE_API_KEY') or os.environ.get('GEMINI_API_KEY')
+
+    # The multi-image request only applies to the Gemini SDK with image files;
+    # Emergent takes precedence when configured, and PDFs need their own upload
+    all_images = all(not filename.lower().endswith('.pdf') for _, filename in files)
+    use_multi_image = (
+        all_images and google_key and GEMINI_AVAILABLE
+        and not (emergent_key and EMERGENT_AVAILABLE)
+    )
+
+    results: Dict[int, Optional[tuple[InvoiceData, ConfidenceScores]]] = {}
+    cache_keys = [extraction_cache_key(file_data, invoice_type) for file_data, _ in files]
+    for i, cache_key in enumerate(cache_keys):
+        cached = get_cached_extraction(cache_key)
+        if cached is not None:
+            results[i] = cached
+    uncached = [i for i in range(len(files)) if i not in results]
+
+    if use_multi_image and len(uncached) > 1:
+        try:
+            prompt = invoice_prompt(invoice_type) + BATCH_PROMPT_SUFFIX.format(count=len(uncached), last=len(uncached) - 1)
+            prepared = await asyncio.gather(*(asyncio.to_thread(prepare_image, files[i][0]) for i in uncached))
+            images = [PIL.Image.open(io.BytesIO(image_data)) for image_data in prepared]
+
+            async def call_gemini_batch(model_name: str) -> str:
+                model = get_gemini_model(google_key, model_name)
+                response = await asyncio.to_thread(model.generate_content, [prompt, *images])
+                return response.text
+
+            # Several invoices in one request need the strongest tier
+            response_text = await call_llm(call_gemini_batch, MODEL_TIERS["gemini"][-1])
+
+            batch_results = {}
+            for item in parse_llm_json(response_text, opener="["):
+                index = item.get("index")
+                if isinstance(index, int) and 0 <= index < len(uncached):
+                    batch_results[uncached[index]] = build_extraction_result(item)
+
+            # Not cached: a result the model attached to the wrong index would be
+            # served for that file's hash on every later upload
+            results.update(batch_results)
+            logging.info(f"Batch extraction of {len(uncached)} invoices successful with Gemini SDK ({len(batch_results)} parsed)")
+        except Exception as e:
+            logging.warning(f"Batch Gemini extraction failed: {str(e)}, extracting files individually...")
+
+    # Anything the batch call did not cover is extracted one file per request
+    missing = [i for i in range(len(files)) if i not in results]
+    if missing:
+        extracted = await extract_invoice_data_many([files[i] for i in missing], invoice_type)
+        results.update(zip(missing, extracted))
+
+    return [results[i] for i in range(len(files))]
 
 # Routes
 @api_router.post("/auth/register")
 async def register(user_data: UserRegister):
-    existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 0})
+    existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 1})
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    password_hash = bcrypt.hashpw(user_data.password.encode(), bcrypt.gensalt()).decode()
+    password_hash = await hash_password(user_data.password)
     
     user = User(
         email=user_data.email,
         name=user_data.name
     )
     
-    user_dict = user.model_dump()
+    user_dict = user.model_dump(mode="json")
     user_dict['password_hash'] = password_hash
-    user_dict['created_at'] = user_dict['created_at'].isoformat()
     
-    await db.users.insert_one(user_dict)
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration for the same email
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     token = create_access_token(user.id, user.email)
     
     return {
-        "user": user.model_dump(),
+        "user": user,
         "token": token
     }
 
@@ -588,17 +1134,14 @@ async def login(credentials: UserLogin):
         raise HTTPException(status_code=403, detail="Your account has been disabled. Please contact administrator.")
     
     password_hash = user_doc.get('password_hash')
-    if not bcrypt.checkpw(credentials.password.encode(), password_hash.encode()):
+    if not await check_password(credentials.password, password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    if isinstance(user_doc['created_at'], str):
-        user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-    
     user = User(**{k: v for k, v in user_doc.items() if k != 'password_hash'})
     token = create_access_token(user.id, user.email)
     
     return {
-        "user": user.model_dump(),
+        "user": user,
         "token": token
     }
 
@@ -622,11 +1165,7 @@ async def forgot_password(request: ForgotPasswordRequest):
 
 @api_router.get("/settings/company")
 async def get_company_settings(current_user: dict = Depends(get_current_user)):
-    settings = await db.company_settings.find_one(
-        {"user_id": current_user['user_id']},
-        {"_id": 0}
-    )
-    return settings or {}
+    return await get_company_settings_cached(current_user['user_id'])
 
 @api_router.post("/settings/company")
 async def update_company_settings(
@@ -643,6 +1182,7 @@ async def update_company_settings(
         {"$set": settings.model_dump()},
         upsert=True
     )
+    _settings_cache.pop(current_user['user_id'], None)
     
     return {"message": "Company settings updated successfully"}
 
@@ -656,32 +1196,27 @@ async def upload_invoice(
     if file.content_type not in allowed_types:
         raise HTTPException(status_code=400, detail="Invalid file type. Only JPEG, PNG, and PDF are allowed.")
     
-    file_data = await file.read()
+    file_data = await read_upload(file)
+    await asyncio.to_thread(validate_invoice_file, file_data, file.content_type)
     
-    extracted_data, confidence_scores = await extract_invoice_data(file_data, file.filename, invoice_type)
+    # GST validation cannot pass without a company GST, so don't spend an LLM call first
+    company_settings = await require_company_gst(current_user['user_id'])
     
-    # Check for duplicate invoice number - BLOCK if duplicate found
-    if extracted_data.invoice_no:
-        is_duplicate, duplicate_ids = await check_duplicate_invoice(
-            current_user['user_id'],
-            extracted_data.invoice_no
-        )
-        if is_duplicate:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Duplicate Invoice Number: Invoice #{extracted_data.invoice_no} already exists in the system (ID: {duplicate_ids[0]}). Please check existing invoices."
-            )
+    extracted_data, confidence_scores = await extract_invoice_data(file_data, file.filename, invoice_type)
     
     # Validate GST number - BLOCK if invalid
     gst_valid, error_message = await validate_gst_number(
         current_user['user_id'],
         invoice_type,
-        extracted_data
+        extracted_data,
+        settings=company_settings
     )
     
     if not gst_valid:
         raise HTTPException(status_code=400, detail=error_message)
     
+    await reject_duplicate_invoice(current_user['user_id'], extracted_data.invoice_no)
+    
     month, fy = get_month_and_fy(extracted_data.invoice_date or "")
     
     # All validations passed
@@ -691,28 +1226,34 @@ async def upload_invoice(
         duplicate_invoice_ids=[]
     )
     
-    file_base64 = base64.b64encode(file_data).decode()
+    file_id = await store_invoice_file(file_data, file.filename, file.content_type, current_user['user_id'])
     
     invoice = Invoice(
         user_id=current_user['user_id'],
         invoice_type=invoice_type,
         filename=file.filename,
-        file_data=file_base64,
+        file_id=file_id,
         file_type=file.content_type,
         extracted_data=extracted_data,
         confidence_scores=confidence_scores,
         validation_flags=validation_flags,
         month=month,
-        financial_year=fy
+        financial_year=fy,
+        invoice_date_iso=to_iso_date(extracted_data.invoice_date or "")
     )
     
+    # Duplicate invoice numbers are BLOCKED by the unique index (or the lookup above while it's missing)
     invoice_dict = invoice.model_dump()
-    invoice_dict['created_at'] = invoice_dict['created_at'].isoformat()
-    invoice_dict['updated_at'] = invoice_dict['updated_at'].isoformat()
-    
-    await db.invoices.insert_one(invoice_dict)
+    try:
+        await db.invoices.insert_one(invoice_dict)
+    except DuplicateKeyError:
+        await delete_invoice_files([invoice_dict])
+        raise await duplicate_invoice_error(current_user['user_id'], extracted_data.invoice_no)
+    invalidate_reports(current_user['user_id'])
     
-    return invoice.model_dump()
+    # The stored document doubles as the response; drop the ObjectId insert_one added
+    invoice_dict.pop('_id')
+    return invoice_dict
 
 @api_router.post("/invoices/batch-upload")
 async def batch_upload_invoices(
@@ -723,40 +1264,81 @@ async def batch_upload_invoices(
     if len(files) > 20:
         raise HTTPException(status_code=400, detail="Maximum 20 files allowed per batch")
     
+    # Company settings cannot change mid-request, so fetch them once for the whole batch;
+    # without a company GST every file would fail validation after its LLM call
+    company_settings = await require_company_gst(current_user['user_id'])
+    company_gst = company_settings['company_gst_no'].upper().strip()
+    
     invoices = []
-    successful = 0
     failed = 0
     errors = []
     
+    allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'application/pdf']
+    accepted_files = []
     for file in files:
+        if file.content_type not in allowed_types:
+            failed += 1
+            errors.append(f"{file.filename}: Invalid file type")
+            continue
+        accepted_files.append(file)
+    
+    # Read and validate all files concurrently, then extract them in a single batch
+    async def preflight(file):
+        try:
+            file_data = await read_upload(file)
+            await asyncio.to_thread(validate_invoice_file, file_data, file.content_type)
+            return file_data, None
+        except HTTPException as e:
+            return None, e.detail
+    
+    preflight_results = await asyncio.gather(*(preflight(file) for file in accepted_files))
+    valid = []
+    for file, (file_data, error) in zip(accepted_files, preflight_results):
+        if error:
+            failed += 1
+            errors.append(f"{file.filename}: {error}")
+        else:
+            valid.append((file, file_data))
+    accepted_files = [file for file, _ in valid]
+    contents = [file_data for _, file_data in valid]
+    
+    extractions = await extract_invoices_batch(
+        [(file_data, file.filename) for file, file_data in zip(accepted_files, contents)],
+        invoice_type
+    )
+    
+    # One query finds every invoice number in the batch that already exists
+    invoice_nos = list({extraction[0].invoice_no for extraction in extractions if extraction and extraction[0].invoice_no})
+    existing_invoice_nos = set()
+    if invoice_nos:
+        existing = await db.invoices.find(
+            {"user_id": current_user['user_id'], "extracted_data.invoice_no": {"$in": invoice_nos}},
+            {"_id": 0, "extracted_data.invoice_no": 1}
+        ).to_list(None)
+        existing_invoice_nos = {inv['extracted_data']['invoice_no'] for inv in existing}
+    
+    accepted = []
+    batch_invoice_nos = set()
+    
+    for file, file_data, extraction in zip(accepted_files, contents, extractions):
+        # Failed extractions are reported rather than stored as empty invoices
+        if extraction is None:
+            failed += 1
+            errors.append(f"{file.filename}: Could not extract invoice data, please try again")
+            continue
+        extracted_data, confidence_scores = extraction
+        
         try:
-            allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'application/pdf']
-            if file.content_type not in allowed_types:
-                failed += 1
-                errors.append(f"{file.filename}: Invalid file type")
-                continue
-            
-            file_data = await file.read()
-            extracted_data, confidence_scores = await extract_invoice_data(file_data, file.filename, invoice_type)
             month, fy = get_month_and_fy(extracted_data.invoice_date or "")
             
-            # Check for duplicates - SKIP if duplicate
-            if extracted_data.invoice_no:
-                is_duplicate, duplicate_ids = await check_duplicate_invoice(
-                    current_user['user_id'],
-                    extracted_data.invoice_no
-                )
-                if is_duplicate:
-                    failed += 1
-                    errors.append(f"{file.filename}: Duplicate invoice #{extracted_data.invoice_no}")
-                    continue
+            # Check for duplicates - SKIP if duplicate (in the database or earlier in this batch)
+            if extracted_data.invoice_no and (extracted_data.invoice_no in existing_invoice_nos or extracted_data.invoice_no in batch_invoice_nos):
+                failed += 1
+                errors.append(f"{file.filename}: Duplicate invoice #{extracted_data.invoice_no}")
+                continue
             
             # Validate GST - SKIP if invalid
-            gst_valid, error_message = await validate_gst_number(
-                current_user['user_id'],
-                invoice_type,
-                extracted_data
-            )
+            gst_valid, error_message = check_gst_match(invoice_type, extracted_data, company_gst)
             if not gst_valid:
                 failed += 1
                 errors.append(f"{file.filename}: {error_message}")
@@ -768,39 +1350,61 @@ async def batch_upload_invoices(
                 duplicate_invoice_ids=[]
             )
             
-            file_base64 = base64.b64encode(file_data).decode()
-            
             invoice = Invoice(
                 user_id=current_user['user_id'],
                 invoice_type=invoice_type,
                 filename=file.filename,
-                file_data=file_base64,
                 file_type=file.content_type,
                 extracted_data=extracted_data,
                 confidence_scores=confidence_scores,
                 validation_flags=validation_flags,
                 month=month,
-                financial_year=fy
+                financial_year=fy,
+                invoice_date_iso=to_iso_date(extracted_data.invoice_date or "")
             )
             
-            invoice_dict = invoice.model_dump()
-            invoice_dict['created_at'] = invoice_dict['created_at'].isoformat()
-            invoice_dict['updated_at'] = invoice_dict['updated_at'].isoformat()
-            
-            await db.invoices.insert_one(invoice_dict)
-            invoices.append(invoice)
-            successful += 1
+            accepted.append((invoice, file_data))
+            if extracted_data.invoice_no:
+                batch_invoice_nos.add(extracted_data.invoice_no)
             
         except Exception as e:
             logging.error(f"Error processing {file.filename}: {str(e)}")
             failed += 1
             errors.append(f"{file.filename}: {str(e)}")
     
+    # Store the accepted files concurrently, then write all invoices in one round-trip
+    file_ids = await asyncio.gather(*(
+        store_invoice_file(file_data, invoice.filename, invoice.file_type, invoice.user_id)
+        for invoice, file_data in accepted
+    ))
+    
+    for (invoice, _), file_id in zip(accepted, file_ids):
+        invoice.file_id = file_id
+        invoices.append(invoice.model_dump())
+    
+    if invoices:
+        try:
+            await db.invoices.insert_many(invoices, ordered=False)
+        except BulkWriteError as e:
+            # A concurrent upload stored the same invoice number after the duplicate lookup above
+            rejected = {error['index'] for error in e.details['writeErrors'] if error['code'] == 11000}
+            if len(rejected) < len(e.details['writeErrors']):
+                raise
+            rejected_invoices = [invoices[i] for i in sorted(rejected)]
+            await delete_invoice_files(rejected_invoices)
+            for invoice_dict in rejected_invoices:
+                failed += 1
+                errors.append(f"{invoice_dict['filename']}: Duplicate invoice #{invoice_dict['extracted_data']['invoice_no']}")
+            invoices = [invoice_dict for i, invoice_dict in enumerate(invoices) if i not in rejected]
+        for invoice_dict in invoices:
+            invoice_dict.pop('_id')
+        invalidate_reports(current_user['user_id'])
+    
     return {
         "total_files": len(files),
-        "successful": successful,
+        "successful": len(invoices),
         "failed": failed,
-        "invoices": [inv.model_dump() for inv in invoices],
+        "invoices": invoices,
         "errors": errors
     }
 
@@ -811,19 +1415,6 @@ async def create_manual_invoice(
 ):
     """Create a manual invoice entry for handwritten or unreadable invoices"""
     
-    # Check for duplicate invoice number
-    invoice_no = invoice_data.extracted_data.get('invoice_no')
-    if invoice_no:
-        is_duplicate, duplicate_ids = await check_duplicate_invoice(
-            current_user['user_id'],
-            invoice_no
-        )
-        if is_duplicate:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Duplicate Invoice Number: Invoice #{invoice_no} already exists in the system (ID: {duplicate_ids[0]}). Please check existing invoices."
-            )
-    
     # Extract date info for month/FY
     invoice_date = invoice_data.extracted_data.get('invoice_date', '')
     month, fy = get_month_and_fy(invoice_date)
@@ -855,56 +1446,109 @@ async def create_manual_invoice(
         user_id=current_user['user_id'],
         invoice_type=invoice_data.invoice_type,
         filename=invoice_data.original_filename,
-        file_data="",  # No file for manual entry
-        file_type="manual",
+        file_type="manual",  # No file for manual entry
         extracted_data=extracted_data,
         confidence_scores={},
         validation_flags=validation_flags,
         status="verified",  # Manual entries are pre-verified
         month=month,
-        financial_year=fy
+        financial_year=fy,
+        invoice_date_iso=to_iso_date(invoice_date or "")
     )
     
     invoice_dict = invoice.model_dump()
-    invoice_dict['created_at'] = invoice_dict['created_at'].isoformat()
-    invoice_dict['updated_at'] = invoice_dict['updated_at'].isoformat()
     invoice_dict['is_manual_entry'] = True
     
-    await db.invoices.insert_one(invoice_dict)
-    
-    return invoice.model_dump()
+    # Duplicate invoice numbers are rejected by the unique index, or looked up first while it's missing
+    await reject_duplicate_invoice(current_user['user_id'], extracted_data.invoice_no)
+    try:
+        await db.invoices.insert_one(invoice_dict)
+    except DuplicateKeyError:
+        raise await duplicate_invoice_error(current_user['user_id'], extracted_data.invoice_no)
+    invalidate_reports(current_user['user_id'])
+    
+    invoice_dict.pop('_id')
+    return invoice_dict
+
+def encode_invoice_cursor(invoice: dict) -> str:
+    """Opaque page cursor for the invoice list, URL-safe so it can be passed back as ?cursor= unescaped"""
+    # The raw isoformat() carries a "+00:00" offset, and an unescaped "+" arrives as a space
+    raw = f"{invoice['created_at'].isoformat()}|{invoice['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_invoice_cursor(cursor: str) -> tuple[datetime, str]:
+    """Inverse of encode_invoice_cursor - raises ValueError on malformed input"""
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_at, invoice_id = raw.split("|", 1)
+    return datetime.fromisoformat(created_at), invoice_id
+
+# Columns needed by list views and dashboard cards (?fields=summary)
+INVOICE_SUMMARY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "filename": 1,
+    "invoice_type": 1,
+    "status": 1,
+    "extracted_data.invoice_no": 1,
+    "extracted_data.invoice_date": 1,
+    "extracted_data.supplier_name": 1,
+    "extracted_data.buyer_name": 1,
+    "extracted_data.total_amount": 1,
+    "validation_flags": 1,
+    "created_at": 1,
+    "month": 1
+}
 
 @api_router.get("/invoices")
 async def get_invoices(
+    response: Response,
     invoice_type: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=1000),
+    fields: Optional[str] = Query(None, pattern="^summary$"),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
+    """List invoices newest first.
+
+    Pass the X-Next-Cursor header of one page as ?cursor= to fetch the next page; skip still works for offset paging.
+    """
     query = {"user_id": current_user['user_id']}
     if invoice_type:
         query["invoice_type"] = invoice_type
     
-    # Date filter
+    # Date filter on the normalised invoice date; accepts DD/MM/YYYY or YYYY-MM-DD
     if start_date or end_date:
         date_query = {}
-        if start_date:
-            date_query["$gte"] = start_date
-        if end_date:
-            date_query["$lte"] = end_date
-        if date_query:
-            query["extracted_data.invoice_date"] = date_query
+        for param, bound, value in (("start_date", "$gte", start_date), ("end_date", "$lte", end_date)):
+            if value:
+                iso_date = to_iso_date(value)
+                if iso_date is None:
+                    raise HTTPException(status_code=400, detail=f"Invalid {param}")
+                date_query[bound] = iso_date
+        query["invoice_date_iso"] = date_query
+    
+    # Keyset pagination: resume strictly after the (created_at, id) of the previous page's last invoice
+    if cursor:
+        try:
+            cursor_created_at, cursor_id = decode_invoice_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["$or"] = [
+            {"created_at": {"$lt": cursor_created_at}},
+            {"created_at": cursor_created_at, "id": {"$lt": cursor_id}}
+        ]
     
+    projection = INVOICE_SUMMARY_PROJECTION if fields == "summary" else {"_id": 0}
     invoices = await db.invoices.find(
         query,
-        {"_id": 0, "file_data": 0}
-    ).sort("created_at", -1).to_list(1000)
+        projection
+    ).sort([("created_at", -1), ("id", -1)]).skip(skip).limit(limit).to_list(limit)
     
-    for invoice in invoices:
-        if isinstance(invoice['created_at'], str):
-            invoice['created_at'] = datetime.fromisoformat(invoice['created_at'])
-        if isinstance(invoice['updated_at'], str):
-            invoice['updated_at'] = datetime.fromisoformat(invoice['updated_at'])
+    if len(invoices) == limit:
+        response.headers["X-Next-Cursor"] = encode_invoice_cursor(invoices[-1])
     
     return invoices
 
@@ -918,27 +1562,52 @@ async def get_invoice(invoice_id: str, current_user: dict = Depends(get_current_
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
-    if isinstance(invoice['created_at'], str):
-        invoice['created_at'] = datetime.fromisoformat(invoice['created_at'])
-    if isinstance(invoice['updated_at'], str):
-        invoice['updated_at'] = datetime.fromisoformat(invoice['updated_at'])
-    
     return invoice
 
-@api_router.put("/invoices/{invoice_id}")
-async def update_invoice(
-    invoice_id: str,
-    update_data: InvoiceUpdate,
-    current_user: dict = Depends(get_current_user)
-):
+@api_router.get("/invoices/{invoice_id}/file")
+async def get_invoice_file(invoice_id: str, current_user: dict = Depends(get_current_user)):
+    """Stream the original invoice file"""
     invoice = await db.invoices.find_one(
         {"id": invoice_id, "user_id": current_user['user_id']},
-        {"_id": 0}
+        {"_id": 0, "file_id": 1, "file_type": 1}
     )
     
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
+    # Manual entries have no file
+    if not invoice.get('file_id'):
+        raise HTTPException(status_code=404, detail="Invoice file not found")
+    
+    try:
+        grid_out = await invoice_files.open_download_stream(ObjectId(invoice['file_id']))
+    except NoFile:
+        raise HTTPException(status_code=404, detail="Invoice file not found")
+    
+    async def iter_chunks():
+        while chunk := await grid_out.readchunk():
+            yield chunk
+    
+    return StreamingResponse(iter_chunks(), media_type=invoice['file_type'])
+
+@api_router.put("/invoices/{invoice_id}")
+async def update_invoice(
+    invoice_id: str,
+    update_data: InvoiceUpdate,
+    current_user: dict = Depends(get_current_user)
+):
+    # The stored type is only read when the update doesn't set one; otherwise the update's
+    # matched_count is the existence check
+    invoice_type = update_data.invoice_type
+    if not invoice_type:
+        invoice = await db.invoices.find_one(
+            {"id": invoice_id, "user_id": current_user['user_id']},
+            {"_id": 0, "invoice_type": 1}
+        )
+        if not invoice:
+            raise HTTPException(status_code=404, detail="Invoice not found")
+        invoice_type = invoice.get('invoice_type', 'purchase')
+    
     month, fy = get_month_and_fy(update_data.extracted_data.invoice_date or "")
     
     # Re-check duplicates
@@ -949,26 +1618,19 @@ async def update_invoice(
     )
     
     # Re-check GST - but don't block update, just flag
-    gst_mismatch = False
-    invoice_type = update_data.invoice_type or invoice.get('invoice_type', 'purchase')
-    
-    # Try to validate GST, but don't fail if validation fails
-    try:
-        gst_valid, _ = await validate_gst_number(
-            current_user['user_id'],
-            invoice_type,
-            update_data.extracted_data
-        )
-        gst_mismatch = not gst_valid
-    except:
-        # If validation fails (e.g., no company settings), just mark as no mismatch
-        gst_mismatch = False
+    # Missing company settings come back as a failed validation, not an exception
+    gst_valid, _ = await validate_gst_number(
+        current_user['user_id'],
+        invoice_type,
+        update_data.extracted_data
+    )
+    gst_mismatch = not gst_valid
     
     update_dict = {
         "extracted_data": update_data.extracted_data.model_dump(),
-        "updated_at": datetime.now(timezone.utc).isoformat(),
         "month": month,
         "financial_year": fy,
+        "invoice_date_iso": to_iso_date(update_data.extracted_data.invoice_date or ""),
         "validation_flags.is_duplicate": is_duplicate,
         "validation_flags.gst_mismatch": gst_mismatch,
         "validation_flags.duplicate_invoice_ids": duplicate_ids
@@ -980,30 +1642,48 @@ async def update_invoice(
     if update_data.invoice_type:
         update_dict["invoice_type"] = update_data.invoice_type
     
-    await db.invoices.update_one(
-        {"id": invoice_id},
-        {"$set": update_dict}
-    )
+    try:
+        result = await db.invoices.update_one(
+            {"id": invoice_id, "user_id": current_user['user_id']},
+            {"$set": update_dict, "$currentDate": {"updated_at": True}}
+        )
+    except DuplicateKeyError:
+        # Another invoice took this number after the duplicate check above
+        raise await duplicate_invoice_error(current_user['user_id'], update_data.extracted_data.invoice_no)
+    
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    invalidate_reports(current_user['user_id'])
     
     return {"message": "Invoice updated successfully"}
 
 @api_router.delete("/invoices/{invoice_id}")
 async def delete_invoice(invoice_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.invoices.delete_one(
-        {"id": invoice_id, "user_id": current_user['user_id']}
+    invoice = await db.invoices.find_one_and_delete(
+        {"id": invoice_id, "user_id": current_user['user_id']},
+        {"_id": 0, "file_id": 1}
     )
     
-    if result.deleted_count == 0:
+    if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
+    invalidate_reports(current_user['user_id'])
+    
+    await delete_invoice_files([invoice])
     
     return {"message": "Invoice deleted successfully"}
 
 @api_router.delete("/invoices")
 async def delete_all_invoices(current_user: dict = Depends(get_current_user)):
     """Delete all invoices for the current user"""
+    invoices = await db.invoices.find(
+        {"user_id": current_user['user_id'], "file_id": {"$ne": None}},
+        {"_id": 0, "file_id": 1}
+    ).to_list(None)
     result = await db.invoices.delete_many(
         {"user_id": current_user['user_id']}
     )
+    invalidate_reports(current_user['user_id'])
+    await delete_invoice_files(invoices)
     
     return {
         "message": f"Successfully deleted {result.deleted_count} invoice(s)",
@@ -1016,51 +1696,69 @@ async def get_monthly_report(
     financial_year: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    query = {"user_id": current_user['user_id'], "status": "verified"}
+    user_id = current_user['user_id']
+    period = ("month", month) if month else ("financial_year", financial_year)
+    reports = _report_cache.get(user_id)
+    if reports is None:
+        reports = _report_cache[user_id] = {}
+    elif period in reports:
+        return reports[period]
+    
+    query = {"user_id": user_id, "status": "verified"}
     
     if month:
         query["month"] = month
     elif financial_year:
         query["financial_year"] = financial_year
     
-    invoices = await db.invoices.find(query, {"_id": 0}).to_list(10000)
-    
-    purchase_invoices = [inv for inv in invoices if inv.get('invoice_type') == 'purchase']
-    sales_invoices = [inv for inv in invoices if inv.get('invoice_type') == 'sales']
-    
-    total_purchase_amount = sum(inv['extracted_data'].get('total_amount', 0) for inv in purchase_invoices)
-    total_sales_amount = sum(inv['extracted_data'].get('total_amount', 0) for inv in sales_invoices)
-    
-    total_purchase_gst = sum(inv['extracted_data'].get('gst', 0) for inv in purchase_invoices)
-    total_sales_gst = sum(inv['extracted_data'].get('gst', 0) for inv in sales_invoices)
+    # Sum per invoice type and GST rate inside Mongo; only the handful of groups come back
+    pipeline = [
+        {"$match": query},
+        {"$group": {
+            "_id": {"type": "$invoice_type", "rate": "$extracted_data.gst_rate"},
+            "count": {"$sum": 1},
+            "taxable_amount": {"$sum": "$extracted_data.basic_amount"},
+            "gst_amount": {"$sum": "$extracted_data.gst"},
+            "total_amount": {"$sum": "$extracted_data.total_amount"}
+        }}
+    ]
+    groups = await (await db.invoices.aggregate(pipeline)).to_list(None)
     
     gst_breakdown = {
         "purchase": {},
         "sales": {}
     }
+    counts = {"purchase": 0, "sales": 0}
+    totals = {"purchase": 0, "sales": 0}
+    gst_totals = {"purchase": 0, "sales": 0}
+    
+    for group in groups:
+        inv_type = group['_id'].get('type')
+        if inv_type not in gst_breakdown:
+            continue
+        # JSON object keys must be strings; keep the labels the report has always shown ("18.0", "null", "unknown")
+        rate = group['_id'].get('rate', 'unknown')
+        rate = "null" if rate is None else str(rate)
+        gst_breakdown[inv_type][rate] = {
+            'count': group['count'],
+            'taxable_amount': group['taxable_amount'],
+            'gst_amount': group['gst_amount']
+        }
+        counts[inv_type] += group['count']
+        totals[inv_type] += group['total_amount']
+        gst_totals[inv_type] += group['gst_amount']
     
-    for inv in purchase_invoices:
-        rate = inv['extracted_data'].get('gst_rate', 'unknown')
-        if rate not in gst_breakdown['purchase']:
-            gst_breakdown['purchase'][rate] = {'count': 0, 'taxable_amount': 0, 'gst_amount': 0}
-        gst_breakdown['purchase'][rate]['count'] += 1
-        gst_breakdown['purchase'][rate]['taxable_amount'] += inv['extracted_data'].get('basic_amount', 0)
-        gst_breakdown['purchase'][rate]['gst_amount'] += inv['extracted_data'].get('gst', 0)
-    
-    for inv in sales_invoices:
-        rate = inv['extracted_data'].get('gst_rate', 'unknown')
-        if rate not in gst_breakdown['sales']:
-            gst_breakdown['sales'][rate] = {'count': 0, 'taxable_amount': 0, 'gst_amount': 0}
-        gst_breakdown['sales'][rate]['count'] += 1
-        gst_breakdown['sales'][rate]['taxable_amount'] += inv['extracted_data'].get('basic_amount', 0)
-        gst_breakdown['sales'][rate]['gst_amount'] += inv['extracted_data'].get('gst', 0)
+    total_purchase_amount = totals['purchase']
+    total_sales_amount = totals['sales']
+    total_purchase_gst = gst_totals['purchase']
+    total_sales_gst = gst_totals['sales']
     
     net_gst_payable = total_sales_gst - total_purchase_gst
     
-    return {
+    reports[period] = {
         "period": month or financial_year or "all",
-        "purchase_invoices": len(purchase_invoices),
-        "sales_invoices": len(sales_invoices),
+        "purchase_invoices": counts['purchase'],
+        "sales_invoices": counts['sales'],
         "total_purchase_amount": round(total_purchase_amount, 2),
         "total_sales_amount": round(total_sales_amount, 2),
         "total_purchase_gst": round(total_purchase_gst, 2),
@@ -1068,6 +1766,7 @@ async def get_monthly_report(
         "net_gst_payable": round(net_gst_payable, 2),
         "gst_breakdown": gst_breakdown
     }
+    return reports[period]
 
 @api_router.get("/reports/months")
 async def get_available_months(current_user: dict = Depends(get_current_user)):
@@ -1077,7 +1776,7 @@ async def get_available_months(current_user: dict = Depends(get_current_user)):
         {"$sort": {"_id": -1}}
     ]
     
-    result = await db.invoices.aggregate(pipeline).to_list(100)
+    result = await (await db.invoices.aggregate(pipeline)).to_list(100)
     months = [item['_id'] for item in result if item['_id']]
     
     return {"months": months}
@@ -1087,130 +1786,172 @@ async def export_invoices(
     export_request: ExportRequest,
     current_user: dict = Depends(get_current_user)
 ):
-    invoices = await db.invoices.find(
-        {"id": {"$in": export_request.invoice_ids}, "user_id": current_user['user_id']},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    if export_request.format == "tally":
-        xml_data = generate_tally_xml(invoices)
-        return {"format": "tally", "data": xml_data}
-    elif export_request.format == "csv":
-        csv_data = generate_csv(invoices)
-        return {"format": "csv", "data": csv_data}
+    query = {"id": {"$in": export_request.invoice_ids}, "user_id": current_user['user_id']}
+    
+    if export_request.format in EXPORT_FORMATS:
+        media_type, extension, stream = EXPORT_FORMATS[export_request.format]
+        cursor = db.invoices.find(query, EXPORT_PROJECTION).batch_size(EXPORT_BATCH_SIZE)
+        return StreamingResponse(
+            stream(cursor),
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="invoices_export.{extension}"'}
+        )
     else:
+        invoices = await db.invoices.find(query, {"_id": 0}).to_list(1000)
         return {"format": "json", "data": invoices}
 
-def generate_tally_xml(invoices: List[Dict]) -> str:
-    xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    xml += '<ENVELOPE>\n'
-    xml += '  <HEADER>\n'
-    xml += '    <TALLYREQUEST>Import Data</TALLYREQUEST>\n'
-    xml += '  </HEADER>\n'
-    xml += '  <BODY>\n'
-    xml += '    <IMPORTDATA>\n'
-    xml += '      <REQUESTDESC>\n'
-    xml += '        <REPORTNAME>Vouchers</REPORTNAME>\n'
-    xml += '      </REQUESTDESC>\n'
-    xml += '      <REQUESTDATA>\n'
-    
-    for invoice in invoices:
-        data = invoice['extracted_data']
-        inv_type = invoice.get('invoice_type', 'purchase')
-        xml += '        <TALLYMESSAGE>\n'
-        xml += '          <VOUCHER>\n'
-        xml += f'            <DATE>{data.get("invoice_date", "")}</DATE>\n'
-        xml += f'            <VOUCHERTYPENAME>{"Purchase" if inv_type == "purchase" else "Sales"}</VOUCHERTYPENAME>\n'
-        xml += f'            <VOUCHERNUMBER>{data.get("invoice_no", "")}</VOUCHERNUMBER>\n'
-        xml += f'            <PARTYLEDGERNAME>{data.get("supplier_name", "")}</PARTYLEDGERNAME>\n'
-        xml += f'            <AMOUNT>{data.get("total_amount", 0)}</AMOUNT>\n'
-        xml += '          </VOUCHER>\n'
-        xml += '        </TALLYMESSAGE>\n'
-    
-    xml += '      </REQUESTDATA>\n'
-    xml += '    </IMPORTDATA>\n'
-    xml += '  </BODY>\n'
-    xml += '</ENVELOPE>'
-    
-    return xml
-
-def generate_csv(invoices: List[Dict]) -> str:
-    csv = "Type,Invoice No,Invoice Date,Party Name,Contact Person,Contact Number,Address,GST No,Basic Amount,GST,Total Amount,Status\n"
-    
-    for invoice in invoices:
-        data = invoice['extracted_data']
-        inv_type = invoice.get('invoice_type', 'purchase')
-        csv += f"{inv_type.capitalize()},"
-        csv += f"{data.get('invoice_no', '')},"
-        csv += f"{data.get('invoice_date', '')},"
-        csv += f"{data.get('supplier_name', '')},"
-        csv += f"{data.get('contact_person', '')},"
-        csv += f"{data.get('contact_number', '')},"
-        csv += f"\"{data.get('address', '')}\","
-        csv += f"{data.get('gst_no', '')},"
-        csv += f"{data.get('basic_amount', '')},"
-        csv += f"{data.get('gst', '')},"
-        csv += f"{data.get('total_amount', '')},"
-        csv += f"{invoice.get('status', '')}\n"
-    
-    return csv
+TALLY_XML_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<ENVELOPE>
+  <HEADER>
+    <TALLYREQUEST>Import Data</TALLYREQUEST>
+  </HEADER>
+  <BODY>
+    <IMPORTDATA>
+      <REQUESTDESC>
+        <REPORTNAME>Vouchers</REPORTNAME>
+      </REQUESTDESC>
+      <REQUESTDATA>
+"""
+
+TALLY_XML_FOOTER = """      </REQUESTDATA>
+    </IMPORTDATA>
+  </BODY>
+</ENVELOPE>"""
+
+TALLY_VOUCHER_TEMPLATE = string.Template("""        <TALLYMESSAGE>
+          <VOUCHER>
+            <DATE>$date</DATE>
+            <VOUCHERTYPENAME>$voucher_type</VOUCHERTYPENAME>
+            <VOUCHERNUMBER>$number</VOUCHERNUMBER>
+            <PARTYLEDGERNAME>$party</PARTYLEDGERNAME>
+            <AMOUNT>$amount</AMOUNT>
+          </VOUCHER>
+        </TALLYMESSAGE>
+""")
+
+CSV_HEADERS = ["Type", "Invoice No", "Invoice Date", "Party Name", "Contact Person", "Contact Number", "Address", "GST No", "Basic Amount", "GST", "Total Amount", "Status"]
+
+# Invoices are pulled from Mongo and flushed to the client this many at a time
+EXPORT_BATCH_SIZE = 200
+EXPORT_PROJECTION = {"_id": 0, "invoice_type": 1, "status": 1, "extracted_data": 1}
+
+def tally_voucher(invoice: Dict) -> str:
+    data = invoice['extracted_data']
+    return TALLY_VOUCHER_TEMPLATE.substitute(
+        date=xml_escape(str(data.get("invoice_date", ""))),
+        voucher_type="Purchase" if invoice.get('invoice_type', 'purchase') == "purchase" else "Sales",
+        number=xml_escape(str(data.get("invoice_no", ""))),
+        party=xml_escape(str(data.get("supplier_name", ""))),
+        amount=data.get("total_amount", 0),
+    )
+
+def csv_row(invoice: Dict) -> tuple:
+    data = invoice['extracted_data']
+    return (
+        invoice.get('invoice_type', 'purchase').capitalize(),
+        data.get('invoice_no', ''),
+        data.get('invoice_date', ''),
+        data.get('supplier_name', ''),
+        data.get('contact_person', ''),
+        data.get('contact_number', ''),
+        data.get('address', ''),
+        data.get('gst_no', ''),
+        data.get('basic_amount', ''),
+        data.get('gst', ''),
+        data.get('total_amount', ''),
+        invoice.get('status', ''),
+    )
+
+async def stream_tally_xml(invoices) -> AsyncIterator[str]:
+    """Yield a Tally import document, one chunk per EXPORT_BATCH_SIZE vouchers"""
+    yield TALLY_XML_HEADER
+    vouchers = []
+    async for invoice in invoices:
+        vouchers.append(tally_voucher(invoice))
+        if len(vouchers) >= EXPORT_BATCH_SIZE:
+            yield "".join(vouchers)
+            vouchers.clear()
+    yield "".join(vouchers) + TALLY_XML_FOOTER
+
+async def stream_csv(invoices) -> AsyncIterator[str]:
+    """Yield CSV text, one chunk per EXPORT_BATCH_SIZE rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(CSV_HEADERS)
+    rows = 0
+    async for invoice in invoices:
+        writer.writerow(csv_row(invoice))
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+# format -> (media type, file extension, chunk generator)
+EXPORT_FORMATS = {
+    "tally": ("application/xml", "xml", stream_tally_xml),
+    "csv": ("text/csv", "csv", stream_csv),
+}
 
 # ============= Bank Reconciliation Endpoints =============
 
-@api_router.post("/bank-statement/upload")
-async def upload_bank_statement(
-    file: UploadFile = File(...),
-    current_user: dict = Depends(get_current_user)
-):
-    """Upload bank statement (PDF or Excel) and extract transactions using AI"""
-    
-    # Validate file type
-    filename = file.filename.lower()
-    if not (filename.endswith('.pdf') or filename.endswith('.xlsx') or filename.endswith('.xls') or filename.endswith('.csv')):
-        raise HTTPException(status_code=400, detail="Only PDF, Excel (.xlsx, .xls) and CSV files are supported")
-    
-    content = await file.read()
-    
-    # Extract text based on file type
-    extracted_text = ""
-    
-    if filename.endswith('.pdf'):
-        # Extract text from PDF
-        try:
-            pdf_reader = PdfReader(io.BytesIO(content))
-            for page in pdf_reader.pages:
-                extracted_text += page.extract_text() + "\n"
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Failed to read PDF: {str(e)}")
-    
-    elif filename.endswith('.csv'):
-        # Read CSV content directly
-        try:
-            extracted_text = content.decode('utf-8')
-        except:
-            extracted_text = content.decode('latin-1')
-    
-    elif filename.endswith(('.xlsx', '.xls')):
-        # Convert Excel to text using pandas
-        try:
-            df = pd.read_excel(io.BytesIO(content))
-            # Convert dataframe to CSV-like text
-            extracted_text = df.to_csv(index=False)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Failed to read Excel file: {str(e)}")
-    
-    else:
-        raise HTTPException(status_code=400, detail="Unsupported file format")
+# Reconciliation only reads the party names/GST of invoices, plus amounts for the reports
+SALES_PARTY_PROJECTION = {
+    "_id": 0,
+    "extracted_data.bill_to_name": 1,
+    "extracted_data.buyer_name": 1,
+    "extracted_data.bill_to_gst": 1,
+    "extracted_data.buyer_gst": 1,
+}
+PURCHASE_PARTY_PROJECTION = {
+    "_id": 0,
+    "extracted_data.supplier_name": 1,
+    "extracted_data.bill_from_name": 1,
+    "extracted_data.supplier_gst": 1,
+    "extracted_data.bill_from_gst": 1,
+}
+INVOICE_AMOUNT_FIELDS = {
+    "id": 1,
+    "extracted_data.invoice_no": 1,
+    "extracted_data.invoice_date": 1,
+    "extracted_data.total_amount": 1,
+}
+STATEMENT_TRANSACTIONS_PROJECTION = {"_id": 0, "id": 1, "transactions": 1}
+
+def make_party_matcher(party_names: List[str], threshold: int = 60):
+    """Build a payment text -> (best matching party, score) function over upper-cased party names
+
+    Each name's significant words are split once per report, and repeated payment texts are scored once.
+    """
+    from rapidfuzz import fuzz, utils
     
-    # Use AI to extract transactions - Supports Emergent, OpenAI, and Gemini
-    emergent_key = os.environ.get('EMERGENT_LLM_KEY')
-    google_key = os.environ.get('GOOGLE_API_KEY') or os.environ.get('GEMINI_API_KEY')
-    openai_key = os.environ.get('OPENAI_API_KEY')
+    significant_words = {name: [w for w in name.split() if len(w) > 3] for name in party_names}
     
-    if not emergent_key and not google_key and not openai_key:
-        raise HTTPException(status_code=500, detail="No LLM API key configured. Set EMERGENT_LLM_KEY, GOOGLE_API_KEY, or OPENAI_API_KEY")
+    @functools.lru_cache(maxsize=None)
+    def match(payment_text: str) -> tuple[Optional[str], int]:
+        payment_text = payment_text.upper()
+        best_match = None
+        best_score = 0
+        
+        for name, words in significant_words.items():
+            # Best of: direct partial match, token set ratio (word order), share of significant words present;
+            # rounded to a whole percentage, which is what the reports show and the threshold compares
+            word_score = (sum(1 for w in words if w in payment_text) / len(words) * 100) if words else 0
+            score = round(max(fuzz.partial_ratio(name, payment_text), fuzz.token_set_ratio(name, payment_text, processor=utils.default_process), word_score))
+            
+            if score > best_score and score >= threshold:
+                best_score = score
+                best_match = name
+                # Nothing can beat a perfect score, and ties keep the first match
+                if best_score >= 100:
+                    break
+        
+        return best_match, best_score
     
-    extraction_prompt = """Analyze this bank statement and extract all transactions. 
+    return match
+
+BANK_STATEMENT_PROMPT = """Analyze this bank statement and extract all transactions. 
 
 For each transaction, extract:
 - date: Transaction date (format as YYYY-MM-DD if possible)
@@ -1254,41 +1995,62 @@ IMPORTANT:
 - If a field is not found, use null
 - Try to identify party names from NEFT/IMPS/UPI descriptions
 """
-    
+
+BANK_SYSTEM_MESSAGE = "You are an expert bank statement data extraction assistant. Return only valid JSON."
+
+# Long statements are split into overlapping windows and extracted in parallel
+BANK_CHUNK_CHARS = int(os.environ.get('BANK_CHUNK_CHARS', '8000'))
+BANK_CHUNK_OVERLAP = int(os.environ.get('BANK_CHUNK_OVERLAP', '400'))
+# One statement may not fan out into more LLM calls than this (25 chunks is about 200k characters)
+BANK_MAX_CHUNKS = int(os.environ.get('BANK_MAX_CHUNKS', '25'))
+# Statement chunks may hold at most this many of the shared llm_semaphore slots, so a long
+# statement can't stall everyone else's invoice uploads
+BANK_LLM_CONCURRENCY = int(os.environ.get('BANK_LLM_CONCURRENCY', '4'))
+bank_llm_semaphore = asyncio.Semaphore(BANK_LLM_CONCURRENCY)
+
+def chunk_statement_text(text: str, max_chars: int = BANK_CHUNK_CHARS, overlap: int = BANK_CHUNK_OVERLAP) -> List[str]:
+    """Split statement text on line boundaries into windows of about max_chars, repeating about overlap chars of trailing lines"""
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        if current and size + len(line) > max_chars:
+            chunks.append("".join(current))
+            # Carry the last few lines over so a transaction split across the boundary is seen whole
+            carried = []
+            carried_size = 0
+            for prev in reversed(current):
+                if carried_size + len(prev) > overlap:
+                    break
+                carried.insert(0, prev)
+                carried_size += len(prev)
+            current = carried
+            size = carried_size
+        current.append(line)
+        size += len(line)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+async def extract_bank_statement_chunk(text: str, emergent_key: Optional[str], google_key: Optional[str], openai_key: Optional[str]) -> str:
+    """Run one chunk of statement text through the first LLM provider that succeeds"""
     last_error = None
     response_text = None
+    # The statement is already text, so every provider gets it inline with the prompt
+    full_prompt = f"{BANK_STATEMENT_PROMPT}\n\nBank Statement Data:\n{text}"
     
     # Method 1: Try Emergent integration first
     if emergent_key and EMERGENT_AVAILABLE:
         try:
             chat = LlmChat(
                 api_key=emergent_key,
-                session_id=str(uuid.uuid4()),
-                system_message="You are an expert bank statement data extraction assistant. Return only valid JSON."
+                session_id=uuid.uuid4().hex,
+                system_message=BANK_SYSTEM_MESSAGE
             ).with_model("gemini", "gemini-2.5-flash")
             
-            temp_file = f"/tmp/{uuid.uuid4()}_statement.txt"
-            with open(temp_file, "w") as f:
-                f.write(extracted_text)
-            
-            file_content = FileContentWithMimeType(
-                file_path=temp_file,
-                mime_type="text/plain"
-            )
-            
-            user_message = UserMessage(
-                text=extraction_prompt,
-                file_contents=[file_content]
-            )
-            
-            response_text = await chat.send_message(user_message)
-            
-            try:
-                os.remove(temp_file)
-            except:
-                pass
+            response_text = await chat.send_message(UserMessage(text=full_prompt))
             
-            logging.info("Bank statement extraction successful with Emergent/Gemini")
+            logging.info("Bank statement chunk extracted with Emergent/Gemini")
         except Exception as e:
             last_error = str(e)
             logging.warning(f"Emergent extraction failed: {str(e)}, trying standard SDKs...")
@@ -1296,13 +2058,11 @@ IMPORTANT:
     # Method 2: Try standard Gemini SDK
     if response_text is None and google_key and GEMINI_AVAILABLE:
         try:
-            genai.configure(api_key=google_key)
-            model = genai.GenerativeModel("gemini-1.5-flash")
+            model = get_gemini_model(google_key, "gemini-1.5-flash")
             
-            full_prompt = f"{extraction_prompt}\n\nBank Statement Data:\n{extracted_text[:50000]}"
-            response = model.generate_content(full_prompt)
+            response = await asyncio.to_thread(model.generate_content, full_prompt)
             response_text = response.text
-            logging.info("Bank statement extraction successful with Gemini SDK")
+            logging.info("Bank statement chunk extracted with Gemini SDK")
         except Exception as e:
             last_error = str(e)
             logging.warning(f"Gemini SDK extraction failed: {str(e)}, trying OpenAI...")
@@ -1310,130 +2070,238 @@ IMPORTANT:
     # Method 3: Fallback to OpenAI SDK
     if response_text is None and openai_key and OPENAI_AVAILABLE:
         try:
-            client = AsyncOpenAI(api_key=openai_key)
+            client = get_openai_client(openai_key)
             
-            full_prompt = f"{extraction_prompt}\n\nBank Statement Data:\n{extracted_text[:30000]}"
             response = await client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
-                    {"role": "system", "content": "You are an expert bank statement data extraction assistant. Return only valid JSON."},
+                    {"role": "system", "content": BANK_SYSTEM_MESSAGE},
                     {"role": "user", "content": full_prompt}
                 ],
                 temperature=0.1
             )
             response_text = response.choices[0].message.content
-            logging.info("Bank statement extraction successful with OpenAI SDK")
+            logging.info("Bank statement chunk extracted with OpenAI SDK")
         except Exception as e:
             last_error = str(e)
             logging.error(f"OpenAI SDK extraction failed: {str(e)}")
     
     if response_text is None:
-        raise HTTPException(status_code=500, detail=f"All AI models failed. Last error: {last_error}")
+        raise ValueError(last_error)
+    
+    return response_text
+
+def parse_bank_statement_response(response_text: str) -> dict:
+    """Parse the LLM's JSON for a bank statement, salvaging individual transactions from malformed output"""
+    # Parse AI response
+    response_text = response_text.strip() if isinstance(response_text, str) else str(response_text)
+    
+    # Remove markdown code blocks
+    response_text = _FENCE_RE.sub("", response_text)
+    
+    # Try to extract just the JSON object; a truncated one is kept from its opening brace for salvage below
+    span = find_json_span(response_text)
+    if span is not None:
+        response_text = span
+    elif '{' in response_text:
+        response_text = response_text[response_text.index('{'):]
+    
+    # Fix common JSON errors
+    # Remove trailing commas before ] or }
+    response_text = _TRAILING_COMMA_RE.sub(r'\1', response_text)
+    # Fix unquoted keys (simple cases)
+    response_text = _UNQUOTED_KEY_RE.sub(r'\1"\2":', response_text)
     
     try:
-        # Parse AI response
-        response_text = response_text.strip() if isinstance(response_text, str) else str(response_text)
+        extracted_data = orjson.loads(response_text.strip())
+    except orjson.JSONDecodeError as je:
+        # If JSON parsing fails, try to extract transactions manually
+        logging.warning(f"JSON parse error: {str(je)}, attempting manual extraction")
         
-        # Remove markdown code blocks
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0]
-        elif "```" in response_text:
-            parts = response_text.split("```")
-            if len(parts) >= 2:
-                response_text = parts[1]
-        
-        # Clean up common JSON issues
-        response_text = response_text.strip()
+        # Create a minimal valid response
+        extracted_data = {
+            "account_info": {},
+            "transactions": [],
+            "summary": {
+                "total_credits": 0,
+                "total_debits": 0
+            }
+        }
         
-        # Try to extract just the JSON object
-        json_match = re.search(r'\{[\s\S]*\}', response_text)
-        if json_match:
-            response_text = json_match.group(0)
+        # Try to find transactions array - handle multi-line
+        trans_start = response_text.find('"transactions"')
+        if trans_start != -1:
+            # Find the opening bracket
+            bracket_start = response_text.find('[', trans_start)
+            if bracket_start != -1:
+                # Find matching closing bracket
+                bracket_count = 1
+                bracket_end = bracket_start + 1
+                while bracket_count > 0 and bracket_end < len(response_text):
+                    if response_text[bracket_end] == '[':
+                        bracket_count += 1
+                    elif response_text[bracket_end] == ']':
+                        bracket_count -= 1
+                    bracket_end += 1
+                
+                trans_text = response_text[bracket_start+1:bracket_end-1]
+                
+                # Find all transaction objects using balanced brace matching
+                i = 0
+                while i < len(trans_text):
+                    if trans_text[i] == '{':
+                        brace_count = 1
+                        start = i
+                        i += 1
+                        while brace_count > 0 and i < len(trans_text):
+                            if trans_text[i] == '{':
+                                brace_count += 1
+                            elif trans_text[i] == '}':
+                                brace_count -= 1
+                            i += 1
+                        
+                        t_obj = trans_text[start:i]
+                        try:
+                            # Clean up the transaction object
+                            t_obj_clean = _TRAILING_COMMA_RE.sub(r'\1', t_obj)
+                            t_obj_clean = _UNQUOTED_KEY_RE.sub(r'\1"\2":', t_obj_clean)
+                            trans = orjson.loads(t_obj_clean)
+                            extracted_data["transactions"].append(trans)
+                        except Exception as te:
+                            logging.debug(f"Failed to parse transaction: {te}")
+                            continue
+                    else:
+                        i += 1
         
-        # Fix common JSON errors
-        # Remove trailing commas before ] or }
-        response_text = re.sub(r',(\s*[}\]])', r'\1', response_text)
-        # Fix unquoted keys (simple cases)
-        response_text = re.sub(r'(\{|\,)\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1"\2":', response_text)
+        # Calculate totals from extracted transactions
+        for t in extracted_data["transactions"]:
+            try:
+                credit = t.get("credit")
+                if credit and str(credit).replace('.','').replace('-','').isdigit():
+                    extracted_data["summary"]["total_credits"] += float(credit)
+            except ValueError:
+                pass
+            try:
+                debit = t.get("debit")
+                if debit and str(debit).replace('.','').replace('-','').isdigit():
+                    extracted_data["summary"]["total_debits"] += float(debit)
+            except ValueError:
+                pass
         
+        logging.info(f"Manual extraction found {len(extracted_data['transactions'])} transactions")
+    
+    return extracted_data
+
+def transaction_key(t: dict) -> tuple:
+    return (t.get('date'), t.get('description'), t.get('reference_no'), t.get('credit'), t.get('debit'), t.get('balance'))
+
+def overlap_length(previous: List[tuple], current: List[tuple]) -> int:
+    """Longest run of transactions that ends previous and starts current"""
+    for k in range(min(len(previous), len(current)), 0, -1):
+        if previous[-k:] == current[:k]:
+            return k
+    return 0
+
+def merge_bank_statement_chunks(results: List[dict]) -> dict:
+    """Combine per-chunk extractions, dropping transactions repeated by the chunk overlap"""
+    if len(results) == 1:
+        return results[0]
+    
+    account_info = {}
+    transactions = []
+    previous_keys = []
+    for result in results:
+        for key, value in (result.get('account_info') or {}).items():
+            if value and not account_info.get(key):
+                account_info[key] = value
+        chunk_transactions = result.get('transactions') or []
+        keys = [transaction_key(t) for t in chunk_transactions]
+        # Only the lines carried over from the previous chunk repeat; identical payments elsewhere are real
+        transactions.extend(chunk_transactions[overlap_length(previous_keys, keys):])
+        previous_keys = keys
+    
+    # Per-chunk summaries only cover their own window, so recompute the totals
+    summary = {"total_credits": 0, "total_debits": 0}
+    for t in transactions:
+        for field, total in (("credit", "total_credits"), ("debit", "total_debits")):
+            try:
+                summary[total] += float(t.get(field) or 0)
+            except (TypeError, ValueError):
+                pass
+    
+    return {"account_info": account_info, "transactions": transactions, "summary": summary}
+
+@api_router.post("/bank-statement/upload")
+async def upload_bank_statement(
+    file: UploadFile = File(...),
+    current_user: dict = Depends(get_current_user)
+):
+    """Upload bank statement (PDF or Excel) and extract transactions using AI"""
+    
+    # Validate file type
+    filename = file.filename.lower()
+    if not (filename.endswith('.pdf') or filename.endswith('.xlsx') or filename.endswith('.xls') or filename.endswith('.csv')):
+        raise HTTPException(status_code=400, detail="Only PDF, Excel (.xlsx, .xls) and CSV files are supported")
+    
+    content = await read_upload(file)
+    
+    # Extract text based on file type
+    extracted_text = ""
+    
+    if filename.endswith('.pdf'):
+        # Extract text from PDF
         try:
-            extracted_data = json.loads(response_text.strip())
-        except json.JSONDecodeError as je:
-            # If JSON parsing fails, try to extract transactions manually
-            logging.warning(f"JSON parse error: {str(je)}, attempting manual extraction")
-            
-            # Create a minimal valid response
-            extracted_data = {
-                "account_info": {},
-                "transactions": [],
-                "summary": {
-                    "total_credits": 0,
-                    "total_debits": 0
-                }
-            }
-            
-            # Try to find transactions array - handle multi-line
-            trans_start = response_text.find('"transactions"')
-            if trans_start != -1:
-                # Find the opening bracket
-                bracket_start = response_text.find('[', trans_start)
-                if bracket_start != -1:
-                    # Find matching closing bracket
-                    bracket_count = 1
-                    bracket_end = bracket_start + 1
-                    while bracket_count > 0 and bracket_end < len(response_text):
-                        if response_text[bracket_end] == '[':
-                            bracket_count += 1
-                        elif response_text[bracket_end] == ']':
-                            bracket_count -= 1
-                        bracket_end += 1
-                    
-                    trans_text = response_text[bracket_start+1:bracket_end-1]
-                    
-                    # Find all transaction objects using balanced brace matching
-                    i = 0
-                    while i < len(trans_text):
-                        if trans_text[i] == '{':
-                            brace_count = 1
-                            start = i
-                            i += 1
-                            while brace_count > 0 and i < len(trans_text):
-                                if trans_text[i] == '{':
-                                    brace_count += 1
-                                elif trans_text[i] == '}':
-                                    brace_count -= 1
-                                i += 1
-                            
-                            t_obj = trans_text[start:i]
-                            try:
-                                # Clean up the transaction object
-                                t_obj_clean = re.sub(r',(\s*[}\]])', r'\1', t_obj)
-                                t_obj_clean = re.sub(r'(\{|\,)\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1"\2":', t_obj_clean)
-                                trans = json.loads(t_obj_clean)
-                                extracted_data["transactions"].append(trans)
-                            except Exception as te:
-                                logging.debug(f"Failed to parse transaction: {te}")
-                                continue
-                        else:
-                            i += 1
-            
-            # Calculate totals from extracted transactions
-            for t in extracted_data["transactions"]:
-                try:
-                    credit = t.get("credit")
-                    if credit and str(credit).replace('.','').replace('-','').isdigit():
-                        extracted_data["summary"]["total_credits"] += float(credit)
-                except:
-                    pass
-                try:
-                    debit = t.get("debit")
-                    if debit and str(debit).replace('.','').replace('-','').isdigit():
-                        extracted_data["summary"]["total_debits"] += float(debit)
-                except:
-                    pass
-            
-            logging.info(f"Manual extraction found {len(extracted_data['transactions'])} transactions")
-        
+            extracted_text = await asyncio.to_thread(extract_pdf_text, content, "\n")
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Failed to read PDF: {str(e)}")
+    
+    elif filename.endswith('.csv'):
+        # Read CSV content directly
+        try:
+            extracted_text = content.decode('utf-8')
+        except UnicodeDecodeError:
+            extracted_text = content.decode('latin-1')
+    
+    elif filename.endswith(('.xlsx', '.xls')):
+        # Convert Excel to text using pandas
+        try:
+            # pandas is only needed for Excel statements, so keep it out of server start-up
+            import pandas as pd
+            df = pd.read_excel(io.BytesIO(content))
+            # Convert dataframe to CSV-like text
+            extracted_text = df.to_csv(index=False)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Failed to read Excel file: {str(e)}")
+    
+    else:
+        raise HTTPException(status_code=400, detail="Unsupported file format")
+    
+    # Use AI to extract transactions - Supports Emergent, OpenAI, and Gemini
+    emergent_key = os.environ.get('EMERGENT_LLM_KEY')
+    google_key = os.environ.get('GOOGLE_API_KEY') or os.environ.get('GEMINI_API_KEY')
+    openai_key = os.environ.get('OPENAI_API_KEY')
+    
+    if not emergent_key and not google_key and not openai_key:
+        raise HTTPException(status_code=500, detail="No LLM API key configured. Set EMERGENT_LLM_KEY, GOOGLE_API_KEY, or OPENAI_API_KEY")
+    
+    chunks = chunk_statement_text(extracted_text)
+    if len(chunks) > BANK_MAX_CHUNKS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Bank statement too long to process ({len(chunks)} sections, maximum {BANK_MAX_CHUNKS}). Please upload a shorter period."
+        )
+    
+    async def extract_chunk(chunk: str) -> str:
+        async with bank_llm_semaphore, llm_semaphore:
+            return await extract_bank_statement_chunk(chunk, emergent_key, google_key, openai_key)
+    
+    responses = await asyncio.gather(*(extract_chunk(chunk) for chunk in chunks), return_exceptions=True)
+    failures = [r for r in responses if isinstance(r, Exception)]
+    if failures:
+        raise HTTPException(status_code=500, detail=f"All AI models failed. Last error: {failures[-1]}")
+    
+    try:
+        extracted_data = merge_bank_statement_chunks([parse_bank_statement_response(r) for r in responses])
     except Exception as e:
         logging.error(f"AI extraction failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to extract transactions: {str(e)}")
@@ -1501,7 +2369,7 @@ async def get_bank_statement_transactions(statement_id: str, current_user: dict
     # Get all buyers from sales invoices
     sales_invoices = await db.invoices.find(
         {"user_id": current_user['user_id'], "invoice_type": "sales"},
-        {"_id": 0}
+        SALES_PARTY_PROJECTION
     ).to_list(10000)
     
     buyers = {}
@@ -1557,7 +2425,7 @@ async def map_transaction_to_buyer(
     # Verify statement belongs to user
     statement = await db.bank_statements.find_one(
         {"id": statement_id, "user_id": current_user['user_id']},
-        {"_id": 0}
+        {"_id": 1}
     )
     
     if not statement:
@@ -1613,24 +2481,22 @@ async def delete_bank_statement(statement_id: str, current_user: dict = Depends(
 @api_router.get("/bank-reconciliation/outstanding")
 async def get_outstanding_report(current_user: dict = Depends(get_current_user)):
     """Generate outstanding report by matching invoices with bank payments using fuzzy matching and manual mappings"""
-    from fuzzywuzzy import fuzz
-    
     # Get all sales invoices for the user
     sales_invoices = await db.invoices.find(
         {"user_id": current_user['user_id'], "invoice_type": "sales"},
-        {"_id": 0}
+        {**SALES_PARTY_PROJECTION, **INVOICE_AMOUNT_FIELDS}
     ).to_list(10000)
     
     # Get all bank statements and their transactions
     bank_statements = await db.bank_statements.find(
         {"user_id": current_user['user_id']},
-        {"_id": 0}
+        STATEMENT_TRANSACTIONS_PROJECTION
     ).to_list(100)
     
     # Get all manual mappings
     manual_mappings = await db.bank_transaction_mappings.find(
         {"user_id": current_user['user_id']},
-        {"_id": 0}
+        {"_id": 0, "statement_id": 1, "transaction_index": 1, "buyer_name": 1}
     ).to_list(10000)
     
     # Create mapping lookup: {statement_id: {transaction_index: buyer_name}}
@@ -1658,13 +2524,6 @@ async def get_outstanding_report(current_user: dict = Depends(get_current_user))
                 }
                 all_payments.append(txn_with_info)
     
-    # Collect all credit transactions (payments received)
-    all_payments = []
-    for statement in bank_statements:
-        for txn in statement.get('transactions', []):
-            if txn.get('credit') and float(txn['credit'] or 0) > 0:
-                all_payments.append(txn)
-    
     # Group invoices by buyer
     buyer_invoices = {}
     for invoice in sales_invoices:
@@ -1689,41 +2548,11 @@ async def get_outstanding_report(current_user: dict = Depends(get_current_user))
             "amount": amount
         })
     
-    # Helper function for fuzzy matching
-    def find_best_buyer_match(payment_text, buyer_names, threshold=60):
-        """Find the best matching buyer name using fuzzy matching"""
-        payment_text = payment_text.upper()
-        best_match = None
-        best_score = 0
-        
-        for buyer_name in buyer_names:
-            # Try different matching strategies
-            
-            # 1. Direct partial match
-            score1 = fuzz.partial_ratio(buyer_name, payment_text)
-            
-            # 2. Token set ratio (handles word order differences)
-            score2 = fuzz.token_set_ratio(buyer_name, payment_text)
-            
-            # 3. Check if significant words match
-            buyer_words = [w for w in buyer_name.split() if len(w) > 3]
-            word_matches = sum(1 for w in buyer_words if w in payment_text)
-            word_score = (word_matches / len(buyer_words) * 100) if buyer_words else 0
-            
-            # Take the best score from all strategies
-            score = max(score1, score2, word_score)
-            
-            if score > best_score and score >= threshold:
-                best_score = score
-                best_match = buyer_name
-        
-        return best_match, best_score
-    
     # Match payments with buyers using fuzzy matching
     buyer_payments = {name: {"payments": [], "total_received": 0} for name in buyer_invoices.keys()}
     unmatched_payments = []
     
-    buyer_names = list(buyer_invoices.keys())
+    find_best_buyer_match = make_party_matcher(list(buyer_invoices.keys()))
     
     for payment in all_payments:
         # Check for manual mapping first
@@ -1744,7 +2573,7 @@ async def get_outstanding_report(current_user: dict = Depends(get_current_user))
             payment_text = f"{party_name} {description}"
             
             # Find best matching buyer
-            matched_buyer, match_score = find_best_buyer_match(payment_text, buyer_names)
+            matched_buyer, match_score = find_best_buyer_match(payment_text)
             
             if matched_buyer:
                 payment_with_match = {**payment, "match_score": match_score, "match_type": "auto", "matched_text": payment_text[:100]}
@@ -1795,24 +2624,22 @@ async def get_outstanding_report(current_user: dict = Depends(get_current_user))
 @api_router.get("/bank-reconciliation/payables")
 async def get_payables_report(current_user: dict = Depends(get_current_user)):
     """Generate payables report - how much we paid for purchase invoices"""
-    from fuzzywuzzy import fuzz
-    
     # Get all purchase invoices for the user
     purchase_invoices = await db.invoices.find(
         {"user_id": current_user['user_id'], "invoice_type": "purchase"},
-        {"_id": 0}
+        {**PURCHASE_PARTY_PROJECTION, **INVOICE_AMOUNT_FIELDS}
     ).to_list(10000)
     
     # Get all bank statements and their transactions
     bank_statements = await db.bank_statements.find(
         {"user_id": current_user['user_id']},
-        {"_id": 0}
+        STATEMENT_TRANSACTIONS_PROJECTION
     ).to_list(100)
     
     # Get all manual mappings for payables
     manual_mappings = await db.bank_payable_mappings.find(
         {"user_id": current_user['user_id']},
-        {"_id": 0}
+        {"_id": 0, "statement_id": 1, "transaction_index": 1, "supplier_name": 1}
     ).to_list(10000)
     
     # Create mapping lookup
@@ -1864,33 +2691,11 @@ async def get_payables_report(current_user: dict = Depends(get_current_user)):
             "amount": amount
         })
     
-    # Helper function for fuzzy matching
-    def find_best_supplier_match(payment_text, supplier_names, threshold=60):
-        payment_text = payment_text.upper()
-        best_match = None
-        best_score = 0
-        
-        for supplier_name in supplier_names:
-            score1 = fuzz.partial_ratio(supplier_name, payment_text)
-            score2 = fuzz.token_set_ratio(supplier_name, payment_text)
-            
-            supplier_words = [w for w in supplier_name.split() if len(w) > 3]
-            word_matches = sum(1 for w in supplier_words if w in payment_text)
-            word_score = (word_matches / len(supplier_words) * 100) if supplier_words else 0
-            
-            score = max(score1, score2, word_score)
-            
-            if score > best_score and score >= threshold:
-                best_score = score
-                best_match = supplier_name
-        
-        return best_match, best_score
-    
     # Match payments with suppliers
     supplier_payments = {name: {"payments": [], "total_paid": 0} for name in supplier_invoices.keys()}
     unmatched_payments = []
     
-    supplier_names = list(supplier_invoices.keys())
+    find_best_supplier_match = make_party_matcher(list(supplier_invoices.keys()))
     
     for payment in all_payments:
         manual_supplier = payment.get('manual_mapping')
@@ -1905,7 +2710,7 @@ async def get_payables_report(current_user: dict = Depends(get_current_user)):
             description = (payment.get('description') or '').strip()
             payment_text = f"{party_name} {description}"
             
-            matched_supplier, match_score = find_best_supplier_match(payment_text, supplier_names)
+            matched_supplier, match_score = find_best_supplier_match(payment_text)
             
             if matched_supplier:
                 payment_with_match = {**payment, "match_score": match_score, "match_type": "auto", "matched_text": payment_text[:100]}
@@ -1965,7 +2770,7 @@ async def get_debit_transactions(statement_id: str, current_user: dict = Depends
     # Get all suppliers from purchase invoices
     purchase_invoices = await db.invoices.find(
         {"user_id": current_user['user_id'], "invoice_type": "purchase"},
-        {"_id": 0}
+        PURCHASE_PARTY_PROJECTION
     ).to_list(10000)
     
     suppliers = {}
@@ -2021,7 +2826,7 @@ async def map_payable_transaction(
     
     statement = await db.bank_statements.find_one(
         {"id": statement_id, "user_id": current_user['user_id']},
-        {"_id": 0}
+        {"_id": 1}
     )
     
     if not statement:
@@ -2070,7 +2875,7 @@ async def bulk_map_transactions(
     
     statement = await db.bank_statements.find_one(
         {"id": statement_id, "user_id": current_user['user_id']},
-        {"_id": 0}
+        {"_id": 1}
     )
     
     if not statement:
@@ -2142,10 +2947,10 @@ async def update_current_user_profile(
     # Update password if both current and new provided
     if update_data.current_password and update_data.new_password:
         password_hash = user_doc.get('password_hash')
-        if not bcrypt.checkpw(update_data.current_password.encode(), password_hash.encode()):
+        if not await check_password(update_data.current_password, password_hash):
             raise HTTPException(status_code=400, detail="Current password is incorrect")
         
-        new_password_hash = bcrypt.hashpw(update_data.new_password.encode(), bcrypt.gensalt()).decode()
+        new_password_hash = await hash_password(update_data.new_password)
         update_dict["password_hash"] = new_password_hash
     
     if not update_dict:
@@ -2173,8 +2978,18 @@ async def get_all_users(current_user: dict = Depends(get_current_user)):
     await check_admin(current_user)
     
     users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
+    user_ids = [u['id'] for u in users]
+    
+    # Fetch company settings and invoice counts for all users in one query each
+    company_settings = await db.company_settings.find({"user_id": {"$in": user_ids}}, {"_id": 0}).to_list(None)
+    company_map = {cs['user_id']: cs for cs in company_settings}
+    
+    invoice_counts = await (await db.invoices.aggregate([
+        {"$match": {"user_id": {"$in": user_ids}}},
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}}}
+    ])).to_list(None)
+    count_map = {c['_id']: c['count'] for c in invoice_counts}
     
-    # Fetch company settings for each user
     result = []
     for user in users:
         # Convert datetime fields
@@ -2193,16 +3008,8 @@ async def get_all_users(current_user: dict = Depends(get_current_user)):
         if 'is_active' not in user:
             user['is_active'] = True
         
-        # Get company settings for this user
-        company_settings = await db.company_settings.find_one(
-            {"user_id": user['id']}, 
-            {"_id": 0}
-        )
-        user['company_details'] = company_settings or {}
-        
-        # Get invoice count for this user
-        invoice_count = await db.invoices.count_documents({"user_id": user['id']})
-        user['invoice_count'] = invoice_count
+        user['company_details'] = company_map.get(user['id'], {})
+        user['invoice_count'] = count_map.get(user['id'], 0)
         
         result.append(user)
     
@@ -2292,7 +3099,7 @@ async def admin_reset_user_password(
         raise HTTPException(status_code=400, detail="Password must be at least 6 characters")
     
     # Hash the new password
-    new_password_hash = bcrypt.hashpw(password_data.new_password.encode(), bcrypt.gensalt()).decode()
+    new_password_hash = await hash_password(password_data.new_password)
     
     await db.users.update_one(
         {"id": user_id},
@@ -2316,9 +3123,16 @@ async def delete_user(user_id: str, current_user: dict = Depends(get_current_use
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Also delete user's invoices and settings
+    # Also delete user's invoices, their stored files and settings
+    invoices = await db.invoices.find(
+        {"user_id": user_id, "file_id": {"$ne": None}},
+        {"_id": 0, "file_id": 1}
+    ).to_list(None)
     await db.invoices.delete_many({"user_id": user_id})
+    invalidate_reports(user_id)
+    await delete_invoice_files(invoices)
     await db.company_settings.delete_many({"user_id": user_id})
+    _settings_cache.pop(user_id, None)
     
     return {"message": "User and associated data deleted successfully"}
 
@@ -2351,18 +3165,41 @@ async def get_all_invoices_admin(
     """Get all invoices from all companies (admin only)"""
     await check_admin(current_user)
     
-    # Get all invoices
-    invoices = await db.invoices.find(
-        {},
-        {"_id": 0, "file_data": 0}
-    ).sort("created_at", -1).to_list(10000)
-    
     # Get all users and their company settings
     users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
     user_map = {u['id']: u for u in users}
     
     company_settings = await db.company_settings.find({}, {"_id": 0}).to_list(1000)
     company_map = {cs['user_id']: cs for cs in company_settings}
+    user_ids = set(user_map) | set(company_map)
+    
+    def display_company(user_id: str) -> str:
+        """Company name as shown in the response; users without company settings show as N/A"""
+        return company_map.get(user_id, {}).get('company_name') or 'N/A'
+    
+    def users_with_company(needle: str) -> list:
+        return [uid for uid in user_ids if needle in display_company(uid).lower()]
+    
+    # Filter in the query; company and user names are resolved to user_ids from the maps above
+    query = {}
+    if invoice_type:
+        query['invoice_type'] = invoice_type
+    
+    if company_name:
+        query['user_id'] = {"$in": users_with_company(company_name.lower())}
+    
+    if search:
+        needle = search.lower()
+        pattern = {"$regex": re.escape(search), "$options": "i"}
+        matching_users = set(users_with_company(needle))
+        matching_users.update(uid for uid, u in user_map.items() if needle in (u.get('name') or '').lower())
+        query['$or'] = [
+            {"extracted_data.invoice_no": pattern},
+            {"extracted_data.supplier_name": pattern},
+            {"user_id": {"$in": list(matching_users)}},
+        ]
+    
+    invoices = await db.invoices.find(query, {"_id": 0}).sort("created_at", -1).to_list(10000)
     
     # Enrich invoices with company details
     result = []
@@ -2372,24 +3209,11 @@ async def get_all_invoices_admin(
         company = company_map.get(user_id, {})
         
         # Add company info to invoice
-        invoice['company_name'] = company.get('company_name', 'N/A')
+        invoice['company_name'] = display_company(user_id)
         invoice['company_gst'] = company.get('company_gst_no', 'N/A')
         invoice['user_name'] = user.get('name', 'Unknown')
         invoice['user_email'] = user.get('email', 'Unknown')
         
-        # Apply filters
-        if company_name and company_name.lower() not in invoice['company_name'].lower():
-            continue
-        
-        if invoice_type and invoice.get('invoice_type') != invoice_type:
-            continue
-        
-        if search:
-            search_lower = search.lower()
-            searchable = f"{invoice.get('company_name', '')} {invoice.get('extracted_data', {}).get('invoice_no', '')} {invoice.get('extracted_data', {}).get('supplier_name', '')} {invoice.get('user_name', '')}".lower()
-            if search_lower not in searchable:
-                continue
-        
         # Convert datetime fields
         if isinstance(invoice.get('created_at'), str):
             pass
@@ -2431,8 +3255,13 @@ async def get_financial_summary(
 ):
     """Get month-wise financial summary for charts"""
     query = {"user_id": current_user['user_id']}
+    if year:
+        query["month"] = {"$regex": f"^{re.escape(year)}"}
     
-    invoices = await db.invoices.find(query, {"_id": 0}).to_list(10000)
+    invoices = await db.invoices.find(
+        query,
+        {"_id": 0, "month": 1, "invoice_type": 1, "extracted_data.total_amount": 1, "extracted_data.gst": 1}
+    ).to_list(10000)
     
     # Group by month
     monthly_data = {}
@@ -2442,9 +3271,6 @@ async def get_financial_summary(
         if not month:
             continue
         
-        if year and not month.startswith(year):
-            continue
-        
         if month not in monthly_data:
             monthly_data[month] = {
                 "month": month,
@@ -2492,7 +3318,10 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+# Invoice lists and exports are repetitive JSON/CSV/XML that compresses several times over
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -2500,6 +3329,71 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def warm_up():
+    """Open a Mongo connection and build the LLM clients before the first request needs them"""
+    await db.command("ping")
+    openai_key = os.environ.get('OPENAI_API_KEY')
+    if openai_key and OPENAI_AVAILABLE:
+        get_openai_client(openai_key)
+    google_key = os.environ.get('GOOGLE_API_KEY') or os.environ.get('GEMINI_API_KEY')
+    if google_key and GEMINI_AVAILABLE:
+        for model_name in MODEL_TIERS["gemini"]:
+            get_gemini_model(google_key, model_name)
+
+async def create_unique_index(collection, keys, remediation: str, **kwargs) -> bool:
+    """Create a unique index; if existing duplicates block it, log how to fix them instead of failing startup"""
+    try:
+        await collection.create_index(keys, unique=True, **kwargs)
+        return True
+    except OperationFailure as e:
+        logger.error(f"Unique index {kwargs.get('name', keys)} on {collection.name} not created, {remediation}: {e}")
+        return False
+
+@app.on_event("startup")
+async def create_indexes():
+    global unique_invoice_no_index
+    # Registration still looks the email up first, so it keeps working while duplicates are resolved
+    await create_unique_index(
+        db.users, "email",
+        "remove or merge the duplicate accounts and restart"
+    )
+    # Single invoice lookups scoped to the owner
+    await create_unique_index(
+        db.invoices, [("user_id", 1), ("id", 1)],
+        "give the duplicated invoice ids new uuids and restart"
+    )
+    # Invoice list: filter by user, newest first, id as the keyset tie-breaker
+    await db.invoices.create_index([("user_id", 1), ("created_at", -1), ("id", -1)])
+    # Duplicate invoice number checks
+    await db.invoices.create_index([("user_id", 1), ("extracted_data.invoice_no", 1)])
+    # One unflagged invoice per number; edits that knowingly reuse a number are flagged and exempt
+    unique_invoice_no_index = await create_unique_index(
+        db.invoices, [("user_id", 1), ("extracted_data.invoice_no", 1)],
+        "falling back to duplicate lookups before insert; resolve existing duplicates and restart",
+        name="user_invoice_no_unique",
+        partialFilterExpression={
+            "extracted_data.invoice_no": {"$gt": ""},
+            "validation_flags.is_duplicate": False
+        }
+    )
+    # Monthly / financial-year reports over verified invoices
+    await db.invoices.create_index([("user_id", 1), ("status", 1), ("month", 1)])
+    await db.invoices.create_index([("user_id", 1), ("status", 1), ("financial_year", 1)])
+    # Available months list
+    await db.invoices.create_index([("user_id", 1), ("month", 1)])
+    # Invoice list filtered by type (same sort as above); the prefix also serves
+    # the sales / purchase lookups in bank reconciliation
+    await db.invoices.create_index([("user_id", 1), ("invoice_type", 1), ("created_at", -1), ("id", -1)])
+    # Admin invoice list across all users, newest first
+    await db.invoices.create_index([("created_at", -1)])
+    # One settings document per user; upserts keep working without it, but racing ones can duplicate
+    await create_unique_index(
+        db.company_settings, "user_id",
+        "keep the newest settings document per user_id, delete the rest and restart"
+    )
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await client.close()
+    await llm_http_client.aclose()
\ No newline at end of file
@@ -242,11 +242,10 @@ class InvoiceAPITester:
             )
             
             if response.status_code == 200:
-                data = response.json()
-                if 'format' in data and 'data' in data:
-                    return self.log_test("Export Invoices", True, f"- Exported as {data['format']}")
+                if response.headers.get('content-type', '').startswith('text/csv') and response.text.startswith('Type,'):
+                    return self.log_test("Export Invoices", True, "- Exported as csv")
                 else:
-                    return self.log_test("Export Invoices", False, "- Missing format or data in response")
+                    return self.log_test("Export Invoices", False, "- Response is not a CSV download")
             else:
                 return self.log_test("Export Invoices", False, f"- Status: {response.status_code}, Response: {response.text}")
                 
@@ -52,6 +52,7 @@ export default function Dashboard() {
       const token = localStorage.getItem("token");
       const response = await axios.get(`${API}/invoices`, {
         headers: { Authorization: `Bearer ${token}` },
+        params: { fields: "summary" },
       });
 
       const invoices = response.data;
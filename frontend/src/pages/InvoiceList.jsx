@@ -205,12 +205,13 @@ export default function InvoiceList() {
       const response = await axios.post(
         `${API}/invoices/export`,
         { invoice_ids: selectedInvoices, format },
-        { headers: { Authorization: `Bearer ${token}` } },
+        {
+          headers: { Authorization: `Bearer ${token}` },
+          responseType: "blob",
+        },
       );
 
-      const data = response.data.data;
-      const blob = new Blob([data], { type: "text/plain" });
-      const url = window.URL.createObjectURL(blob);
+      const url = window.URL.createObjectURL(response.data);
       const a = document.createElement("a");
       a.href = url;
       a.download = `invoices_export.${format === "tally" ? "xml" : format}`;
@@ -22,6 +22,8 @@ export default function VerifyInvoice() {
   const [loading, setLoading] = useState(true);
   const [saving, setSaving] = useState(false);
   const [zoom, setZoom] = useState(1);
+  const [fileUrl, setFileUrl] = useState(null);
+  const [fileUnavailable, setFileUnavailable] = useState(false);
   const [formData, setFormData] = useState({
     invoice_no: '',
     invoice_date: '',
@@ -52,10 +54,17 @@ export default function VerifyInvoice() {
     loadInvoice();
   }, [id]);
 
+  useEffect(() => {
+    return () => {
+      if (fileUrl) window.URL.revokeObjectURL(fileUrl);
+    };
+  }, [fileUrl]);
+
   const loadInvoice = async () => {
+    const token = localStorage.getItem('token');
+    let response;
     try {
-      const token = localStorage.getItem('token');
-      const response = await axios.get(`${API}/invoices/${id}`, {
+      response = await axios.get(`${API}/invoices/${id}`, {
         headers: { Authorization: `Bearer ${token}` }
       });
       setInvoice(response.data);
@@ -89,6 +98,21 @@ export default function VerifyInvoice() {
     } catch (error) {
       toast.error('Failed to load invoice');
       navigate('/invoices');
+      return;
+    }
+
+    // The form doesn't wait on the file, and a missing file only loses the preview
+    if (response.data.file_type !== 'manual') {
+      try {
+        const fileResponse = await axios.get(`${API}/invoices/${id}/file`, {
+          headers: { Authorization: `Bearer ${token}` },
+          responseType: 'blob'
+        });
+        setFileUrl(window.URL.createObjectURL(fileResponse.data));
+        setFileUnavailable(false);
+      } catch (error) {
+        setFileUnavailable(true);
+      }
     }
   };
 
@@ -233,9 +257,16 @@ export default function VerifyInvoice() {
             </CardHeader>
             <CardContent>
               <div className="overflow-auto max-h-[800px] bg-muted/30 rounded-sm p-4">
-                {invoice.file_type === 'application/pdf' ? (
+                {fileUnavailable ? (
+                  <div
+                    className="flex items-center justify-center h-64 text-sm text-muted-foreground"
+                    data-testid="preview-unavailable"
+                  >
+                    Preview unavailable - the original file could not be loaded
+                  </div>
+                ) : invoice.file_type === 'application/pdf' ? (
                   <embed
-                    src={`data:application/pdf;base64,${invoice.file_data}`}
+                    src={fileUrl}
                     type="application/pdf"
                     data-testid="pdf-preview"
                     width="100%"
@@ -244,7 +275,7 @@ export default function VerifyInvoice() {
                   />
                 ) : (
                   <img
-                    src={`data:${invoice.file_type};base64,${invoice.file_data}`}
+                    src={fileUrl}
                     alt="Invoice"
                     data-testid="image-preview"
                     className="max-w-full h-auto rounded-sm"
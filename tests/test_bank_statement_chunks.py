@@ -0,0 +1,100 @@
+"""
+Unit tests for splitting long bank statements into overlapping chunks and merging the per-chunk extractions
+Runs without a server; the module only needs Mongo settings to import, it never connects
+"""
+import os
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'invoice_ocr_test')
+
+from backend.server import chunk_statement_text, merge_bank_statement_chunks
+
+def statement_lines(count):
+    return [f"{day:02d}/04/2024 UPI/PAYMENT/{day:04d} 500.00 {10000 + day * 500:.2f}\n" for day in range(1, count + 1)]
+
+def txn(date, description="UPI", debit=500, **extra):
+    return {"date": date, "description": description, "debit": debit, **extra}
+
+class TestChunkStatementText:
+    """Line-aligned windows with a small repeated tail"""
+
+    def test_short_text_is_one_chunk(self):
+        """Text under the limit is passed through as a single chunk"""
+        text = "".join(statement_lines(3))
+        assert chunk_statement_text(text, max_chars=8000, overlap=400) == [text]
+
+    def test_chunks_split_on_lines_within_the_limit(self):
+        """Every chunk is whole lines and no longer than max_chars"""
+        lines = statement_lines(40)
+        chunks = chunk_statement_text("".join(lines), max_chars=300, overlap=100)
+        assert len(chunks) > 1
+        for chunk in chunks:
+            assert len(chunk) <= 300
+            assert all(line in lines for line in chunk.splitlines(keepends=True))
+
+    def test_each_chunk_repeats_the_tail_of_the_previous(self):
+        """The overlap carries the last lines of a chunk into the next one"""
+        chunks = chunk_statement_text("".join(statement_lines(40)), max_chars=300, overlap=100)
+        for previous, current in zip(chunks, chunks[1:]):
+            previous_lines = previous.splitlines(keepends=True)
+            current_lines = current.splitlines(keepends=True)
+            carried = [line for line in current_lines if line in previous_lines]
+            assert 0 < len("".join(carried)) <= 100
+            assert previous_lines[-len(carried):] == current_lines[:len(carried)]
+
+    def test_every_line_is_covered(self):
+        """Dropping the repeated lines gives back the original text"""
+        lines = statement_lines(40)
+        chunks = chunk_statement_text("".join(lines), max_chars=300, overlap=100)
+        seen = []
+        for chunk in chunks:
+            for line in chunk.splitlines(keepends=True):
+                if line not in seen:
+                    seen.append(line)
+        assert seen == lines
+
+class TestMergeBankStatementChunks:
+    """Only transactions repeated by the chunk overlap are dropped"""
+
+    def test_single_chunk_is_returned_as_is(self):
+        """One chunk keeps its own summary"""
+        result = {"account_info": {}, "transactions": [txn("d"), txn("d")], "summary": {"total_debits": 1000}}
+        assert merge_bank_statement_chunks([result]) is result
+
+    def test_overlap_at_the_boundary_is_dropped(self):
+        """Transactions ending one chunk and starting the next are kept once"""
+        first = {"transactions": [txn("01/04"), txn("02/04"), txn("03/04")]}
+        second = {"transactions": [txn("02/04"), txn("03/04"), txn("04/04")]}
+        merged = merge_bank_statement_chunks([first, second])
+        assert [t["date"] for t in merged["transactions"]] == ["01/04", "02/04", "03/04", "04/04"]
+        assert merged["summary"]["total_debits"] == 2000
+
+    def test_identical_payments_inside_a_chunk_are_kept(self):
+        """Two real identical payments on the same day both count"""
+        first = {"transactions": [txn("d"), txn("d")]}
+        second = {"transactions": [txn("e", debit=100)]}
+        merged = merge_bank_statement_chunks([first, second])
+        assert len(merged["transactions"]) == 3
+        assert merged["summary"]["total_debits"] == 1100
+
+    def test_identical_payment_after_the_overlap_is_kept(self):
+        """A repeat further into the next chunk is a new payment, not overlap"""
+        first = {"transactions": [txn("d")]}
+        second = {"transactions": [txn("d"), txn("e", debit=100), txn("d")]}
+        merged = merge_bank_statement_chunks([first, second])
+        assert len(merged["transactions"]) == 3
+        assert merged["summary"]["total_debits"] == 1100
+
+    def test_reference_number_tells_payments_apart(self):
+        """Same date and amount with different references are different payments"""
+        first = {"transactions": [txn("d", reference_no="R1")]}
+        second = {"transactions": [txn("d", reference_no="R2")]}
+        merged = merge_bank_statement_chunks([first, second])
+        assert len(merged["transactions"]) == 2
+
+    def test_account_info_is_filled_from_any_chunk(self):
+        """Fields missing from the first chunk are taken from later ones"""
+        first = {"account_info": {"bank_name": "HDFC", "account_number": ""}, "transactions": []}
+        second = {"account_info": {"bank_name": "", "account_number": "1234"}, "transactions": []}
+        merged = merge_bank_statement_chunks([first, second])
+        assert merged["account_info"] == {"bank_name": "HDFC", "account_number": "1234"}
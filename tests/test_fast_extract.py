@@ -0,0 +1,87 @@
+"""
+Unit tests for the regex fast path over invoice PDF text (fast_extract_invoice)
+Runs without a server; the module only needs Mongo settings to import, it never connects
+"""
+import os
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'invoice_ocr_test')
+
+from backend.server import FAST_PATH_CONFIDENCE, fast_extract_invoice
+
+SELLER_GST = "27AAPFU0939F1ZV"
+BUYER_GST = "29AAGCB7383J1Z4"
+
+def invoice_text(invoice_no_line="Invoice No: INV-2024/001", date_lines="Invoice Date: 15/04/2024",
+                 party_lines=None):
+    if party_lines is None:
+        party_lines = (
+            f"Supplier Name: Acme Traders\nGSTIN: {SELLER_GST}\n"
+            f"Buyer Name: Beta Industries\nGSTIN: {BUYER_GST}"
+        )
+    return "\n".join([
+        "TAX INVOICE",
+        invoice_no_line,
+        date_lines,
+        party_lines,
+        "Taxable Value: 1,000.00",
+        "Total GST: 180.00",
+        "Grand Total: 1,180.00",
+    ])
+
+class TestFastExtractInvoice:
+    """Regex fast path over labelled invoice text"""
+
+    def test_labelled_invoice_is_extracted_for_review(self):
+        """A plainly labelled invoice is extracted, scored in the review band"""
+        data, scores = fast_extract_invoice(invoice_text())
+        assert data.invoice_no == "INV-2024/001"
+        assert data.invoice_date == "15/04/2024"
+        assert data.supplier_gst_no == SELLER_GST
+        assert data.buyer_gst_no == BUYER_GST
+        assert data.total_amount == 1180.0
+        assert scores.invoice_no == FAST_PATH_CONFIDENCE < 0.9
+
+    def test_invoice_notes_is_not_an_invoice_number(self):
+        """'Invoice Notes' must not be read as 'Invoice No' + 'tes'"""
+        text = invoice_text(invoice_no_line="Invoice Notes: deliver to gate 2")
+        assert fast_extract_invoice(text) is None
+
+    @pytest.mark.parametrize("label", ["Due", "Order", "PO"])
+    def test_non_invoice_dates_are_skipped(self, label):
+        """Due / order dates printed before the invoice date are not taken as it"""
+        text = invoice_text(date_lines=f"{label} Date: 30/04/2024\nInvoice Date: 15/04/2024")
+        data, _ = fast_extract_invoice(text)
+        assert data.invoice_date == "15/04/2024"
+
+    def test_only_due_date_falls_back(self):
+        """Without an invoice date the fast path gives up instead of using the due date"""
+        text = invoice_text(date_lines="Due Date: 30/04/2024")
+        assert fast_extract_invoice(text) is None
+
+    def test_gstins_follow_their_labels_when_buyer_comes_first(self):
+        """A buyer block printed before the seller's keeps each GSTIN with its party"""
+        parties = (
+            f"Buyer Name: Beta Industries\nGSTIN: {BUYER_GST}\n"
+            f"Supplier Name: Acme Traders\nGSTIN: {SELLER_GST}"
+        )
+        data, _ = fast_extract_invoice(invoice_text(party_lines=parties))
+        assert data.supplier_gst_no == SELLER_GST
+        assert data.buyer_gst_no == BUYER_GST
+
+    def test_letterhead_gstin_belongs_to_the_seller(self):
+        """A GSTIN above both party labels is the seller's letterhead"""
+        parties = (
+            f"GSTIN: {SELLER_GST}\nSupplier Name: Acme Traders\n"
+            f"Buyer Name: Beta Industries\nGSTIN: {BUYER_GST}"
+        )
+        data, _ = fast_extract_invoice(invoice_text(party_lines=parties))
+        assert data.supplier_gst_no == SELLER_GST
+        assert data.buyer_gst_no == BUYER_GST
+
+    def test_buyer_gstin_alone_is_not_used_as_the_sellers(self):
+        """When only the buyer's GSTIN is printed the fast path gives up"""
+        parties = f"Supplier Name: Acme Traders\nBuyer Name: Beta Industries\nGSTIN: {BUYER_GST}"
+        assert fast_extract_invoice(invoice_text(party_lines=parties)) is None
@@ -0,0 +1,38 @@
+"""
+Unit tests for bank payment -> party matching (make_party_matcher)
+Runs without a server; the module only needs Mongo settings to import, it never connects
+"""
+import os
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'invoice_ocr_test')
+
+from backend.server import make_party_matcher
+
+class TestPartyMatcher:
+    """Scores are whole percentages compared against the default threshold of 60"""
+
+    @pytest.mark.parametrize("party, payment_text, expected", [
+        # Name printed in full inside the narration
+        ("ACME TRADERS", "neft/acme traders pvt", ("ACME TRADERS", 100)),
+        # Just above the threshold
+        ("KRISHNA STEEL CORPORATION", "RTGS KRISHNA STEELS", ("KRISHNA STEEL CORPORATION", 81)),
+        ("ALPHA CHEMICALS", "NEFT ALPHA PHARMA", ("ALPHA CHEMICALS", 67)),
+        ("SHREE GANESH ENTERPRISES", "UPI/GANESH ENTERP/9876", ("SHREE GANESH ENTERPRISES", 65)),
+        # Just below it (best scores 57 and 53)
+        ("BETA INDUSTRIES", "IMPS BETA IND 1234", (None, 0)),
+        ("MEHTA AND SONS", "CHQ 001234 MEHTA", (None, 0)),
+    ])
+    def test_known_pairs_at_the_threshold(self, party, payment_text, expected):
+        """Pinned scores for narrations around the match threshold"""
+        match = make_party_matcher([party])
+        result = match(payment_text)
+        assert result == expected
+        assert isinstance(result[1], int)
+
+    def test_best_party_wins(self):
+        """The highest scoring party is returned when several pass the threshold"""
+        match = make_party_matcher(["ALPHA CHEMICALS", "ALPHA PHARMA"])
+        assert match("NEFT ALPHA PHARMA") == ("ALPHA PHARMA", 100)